@@ -0,0 +1,110 @@
+"""Выбор обработчика кнопки: цепочка CallbackQueryHandler с regex против роутера.
+
+Прежняя схема — десять CallbackQueryHandler с pattern, которые Application
+перебирает по порядку до первого совпадения. Роутер — один обработчик:
+разбор callback_data, поиск в CALLBACK_ROUTES и проверка аргументов.
+Время — на один апдейт, без самих обработчиков.
+
+    python benchmarks/bench_callbacks.py --rounds 20000
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler
+
+import bot
+
+# Порядок регистрации до роутера
+OLD_PATTERNS = [
+    "^book$", "^master_", "^svc_", "^date_", "^time_", "^back_",
+    "^(confirm_book|cancel_flow)$", "^cancel_", "^admin_cancel_", "^adm_",
+]
+
+BID = 1234567890123
+MID = bot.default_master().id
+# (старая callback_data, новая)
+TAPS = [
+    ("book", bot.cb("b")),
+    ("svc_1", bot.cb("s", 1)),
+    ("svc_done", bot.cb("sd")),
+    ("date_2030-01-01", bot.cb("d", "2030-01-01")),
+    ("time_10:45", bot.cb("t", "1045")),
+    ("back_dates", bot.cb("bd")),
+    ("confirm_book", bot.cb("cb")),
+    (f"cancel_{BID}", bot.cb("c", BID)),
+    (f"admin_cancel_{BID}", bot.cb("ac", BID)),
+    (f"adm_p_{MID}_all_1", bot.cb("ap", MID, "all", 1)),
+]
+
+
+async def noop(update, context):
+    pass
+
+
+def make_update(data):
+    return Update.de_json({
+        "update_id": 1,
+        "callback_query": {
+            "id": "1",
+            "chat_instance": "1",
+            "data": data,
+            "from": {"id": 1, "is_bot": False, "first_name": "U"},
+            "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}},
+        },
+    }, None)
+
+
+def chain_dispatch(handlers, update):
+    # Как Application.process_update внутри группы: первый check_update, который сработал
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler
+    return None
+
+
+def router_dispatch(handler, update):
+    handler.check_update(update)
+    code, args = bot.parse_callback(update.callback_query.data)
+    fn, checks = bot.CALLBACK_ROUTES[code]
+    return fn, [check(value) for check, value in zip(checks, args)]
+
+
+def per_update(fn, rounds):
+    start = perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+
+    chain = [CallbackQueryHandler(noop, pattern=p) for p in OLD_PATTERNS]
+    router = CallbackQueryHandler(noop)
+
+    print(f"{'callback':<28} {'regex, мкс':>11} {'роутер, мкс':>12} {'старая→роутер':>14}")
+    totals = [0.0, 0.0, 0.0]
+    for old, new in TAPS:
+        old_update, new_update = make_update(old), make_update(new)
+        assert chain_dispatch(chain, old_update) is not None, old
+        row = [
+            per_update(lambda: chain_dispatch(chain, old_update), args.rounds),
+            per_update(lambda: router_dispatch(router, new_update), args.rounds),
+            per_update(lambda: router_dispatch(router, old_update), args.rounds),
+        ]
+        totals = [t + x for t, x in zip(totals, row)]
+        print(f"{old:<28} {row[0]:>11.2f} {row[1]:>12.2f} {row[2]:>14.2f}")
+    n = len(TAPS)
+    print(f"{'среднее':<28} {totals[0] / n:>11.2f} {totals[1] / n:>12.2f} {totals[2] / n:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Пропускная способность PerChatUpdateProcessor в зависимости от параллелизма.
+
+Каждый апдейт имитирует обработчик, который ждёт ответа Telegram API
+(--latency мс). Проверяется и порядок: апдейты одного чата должны
+выполниться в том порядке, в каком пришли.
+
+    python benchmarks/bench_concurrency.py --users 200 --taps 5 --latency 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+
+import bot
+
+
+def make_update(update_id, chat_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(chat_id),
+            "data": "svc_1",
+            "from": {"id": chat_id, "is_bot": False, "first_name": "U"},
+            "message": {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+            },
+        },
+    }, None)
+
+
+async def run(concurrency, users, taps, latency):
+    # Меряем сам процессор: лимиты (admit) отбросили бы синтетические нажатия
+    processor = bot.PerChatUpdateProcessor(concurrency, admission=False)
+    seen = {}
+
+    async def handler(chat_id, seq):
+        await asyncio.sleep(latency)
+        seen.setdefault(chat_id, []).append(seq)
+
+    updates = []
+    for seq in range(taps):
+        for chat_id in range(1, users + 1):
+            updates.append((make_update(len(updates), chat_id), chat_id, seq))
+
+    start = perf_counter()
+    await asyncio.gather(*(
+        processor.process_update(update, handler(chat_id, seq))
+        for update, chat_id, seq in updates
+    ))
+    elapsed = perf_counter() - start
+
+    ordered = all(v == sorted(v) for v in seen.values())
+    return len(updates) / elapsed, elapsed, ordered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--taps", type=int, default=5, help="апдейтов на пользователя")
+    parser.add_argument("--latency", type=float, default=20, help="задержка обработчика, мс")
+    parser.add_argument("--levels", default="1,4,16,64,256")
+    args = parser.parse_args()
+
+    print(f"{'concurrency':>11} {'updates/s':>10} {'seconds':>8}  per-chat order")
+    for level in (int(x) for x in args.levels.split(",")):
+        rate, elapsed, ordered = asyncio.run(run(level, args.users, args.taps, args.latency / 1000))
+        print(f"{level:>11} {rate:>10.0f} {elapsed:>8.2f}  {'ok' if ordered else 'BROKEN'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Холодный старт: снимок bookings.json против бинарного bookings.snap.
+
+Оба снимка строятся из одних и тех же записей. Каждая загрузка идёт в
+отдельном процессе, чтобы RSS не смешивался: время чтения снимка,
+время до готового индекса BookingStore (после этого бот уже отвечает),
+сколько записей бинарного снимка при этом пришлось разобрать целиком,
+время пересчёта статистики (после неаккуратной остановки), время
+разбора всех полей всех записей и прирост RSS после загрузки.
+
+Записи двух видов: нынешние и старые — без duration, service_ids и
+master, как их оставили версии до длительностей услуг. Именно старые
+бот загружает после обновления.
+
+    python benchmarks/bench_snapshot.py --bookings 100000 --runs 3
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+from datetime import date, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+FORMATS = ("json", "binary")
+SHAPES = ("current", "legacy")
+LEGACY_MISSING = ("duration", "service_ids", "master")
+
+
+def make_bookings(n, seed=1, legacy=False):
+    rng = random.Random(seed)
+    slots = bot.generate_times()
+    start = date.today()
+    bookings = []
+    for i in range(n):
+        services = rng.sample(bot.SERVICES, rng.randint(1, 2))
+        bookings.append({
+            "id": 1700000000000 + i,
+            "master": bot.default_master().id,
+            "user_id": str(rng.randint(10**8, 10**10)),
+            "name": f"Клиент {i}",
+            "phone": f"+99890{rng.randint(0, 9999999):07d}",
+            "services": [s["name"] for s in services],
+            "service_ids": [s["id"] for s in services],
+            "price": sum(s["price"] for s in services),
+            "date": (start + timedelta(days=rng.randint(-300, 30))).isoformat(),
+            "time": rng.choice(slots),
+            "duration": sum(s["duration"] for s in services),
+            "status": "confirmed" if rng.random() < 0.8 else "cancelled",
+            "created": "2024-01-01T10:00:00",
+        })
+        if legacy:
+            for key in LEGACY_MISSING:
+                del bookings[-1][key]
+    return bookings
+
+
+def decoded(records):
+    return sum(1 for b in records if isinstance(b, bot.LazyBooking) and b._cold is None)
+
+
+def rss_mb():
+    # Текущий RSS; где нет /proc — пиковый (ru_maxrss: килобайты в Linux, байты в macOS)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 2**20 if sys.platform == "darwin" else rss / 1024
+
+
+def child(folder):
+    base = rss_mb()
+    storage = bot.JournalStorage(
+        os.path.join(folder, bot.DATA_FILE),
+        os.path.join(folder, bot.JOURNAL_FILE),
+        os.path.join(folder, bot.SNAPSHOT_FILE),
+    )
+    slots = bot.generate_times()
+    t0 = perf_counter()
+    records = storage.load()
+    t1 = perf_counter()
+    store = bot.BookingStore(storage, slots)
+    store.bookings = records
+    store.reindex()
+    t2 = perf_counter()
+    rss = rss_mb()
+    indexed = decoded(records)
+    stats = bot.Stats(os.path.join(folder, bot.STATS_FILE), store)
+    stats.rebuild(bot.Archive(os.path.join(folder, bot.ARCHIVE_DIR)))
+    t3 = perf_counter()
+    for b in records:
+        b.get("phone")
+    t4 = perf_counter()
+    print(json.dumps({
+        "load": t1 - t0, "index": t2 - t0, "decoded": indexed, "stats": t3 - t2, "touch": t4 - t3,
+        "rss": rss - base, "rss_full": rss_mb() - base,
+    }))
+
+
+def measure(folder, runs):
+    best = None
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", folder],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        row = json.loads(out.splitlines()[-1])
+        best = row if best is None else {k: min(best[k], row[k]) for k in row}
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bookings", type=int, default=100000)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    print(f"записей: {args.bookings}, лучший из {args.runs} запусков")
+    print(f"{'записи':<8} {'снимок':<8} {'МБ':>7} {'чтение, мс':>11} {'индекс, мс':>11} {'разобрано':>10} "
+          f"{'статистика, мс':>15} {'все поля, мс':>13} {'RSS, МБ':>8} {'RSS полн., МБ':>14}")
+    for shape in SHAPES:
+        bookings = make_bookings(args.bookings, legacy=shape == "legacy")
+        with tempfile.TemporaryDirectory() as tmp:
+            folders = {fmt: os.path.join(tmp, fmt) for fmt in FORMATS}
+            for folder in folders.values():
+                os.makedirs(folder)
+            json_path = os.path.join(folders["json"], bot.DATA_FILE)
+            snap_path = os.path.join(folders["binary"], bot.SNAPSHOT_FILE)
+            bot.atomic_write_json(json_path, bookings, indent=2)
+            bot.write_snapshot_file(snap_path, bookings)
+            sizes = {"json": os.path.getsize(json_path), "binary": os.path.getsize(snap_path)}
+
+            for fmt in FORMATS:
+                row = measure(folders[fmt], args.runs)
+                print(f"{shape:<8} {fmt:<8} {sizes[fmt] / 2**20:>7.1f} {row['load'] * 1000:>11.0f} "
+                      f"{row['index'] * 1000:>11.0f} {row['decoded'] if fmt == 'binary' else '—':>10} "
+                      f"{row['stats'] * 1000:>15.0f} {row['touch'] * 1000:>13.0f} "
+                      f"{row['rss']:>8.1f} {row['rss_full']:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""Нагрузочный прогон полного сценария записи через настоящие обработчики bot.py.
+
+Сеть не нужна: Bot работает поверх поддельного транспорта, который
+отвечает на вызовы Bot API локально (с задержкой --api-latency мс).
+Каждый пользователь проходит /start → запись → [мастер] → услуги → готово
+→ дата → время → имя → телефон → подтверждение; часть отменяет запись,
+админ параллельно листает /bookings. Все файлы пишутся во временный
+каталог.
+
+    python benchmarks/load_test.py --users 500 --existing 5000 --backend json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from datetime import date, timedelta
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Bot, Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+ADMIN_ID = 1
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeTransport(BaseRequest):
+    """Отвечает на вызовы Bot API без сети и запоминает последнюю клавиатуру в каждом чате."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+        self.markups = {}
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data is not None else {}
+
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            if "reply_markup" in params:
+                self.markups[chat_id] = params["reply_markup"]
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class Simulation:
+    def __init__(self, app, transport):
+        self.app = app
+        self.transport = transport
+        self.update_id = 0
+        self.latencies = {}  # шаг -> [время обработчиков, с]
+        self.waits = {}      # шаг -> [от прихода апдейта до конца обработки, с]
+        self.outcomes = Counter()
+
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid}"}
+
+    def message(self, uid, text=None, contact=None):
+        data = {
+            "message_id": self._next_id(),
+            "date": 0,
+            "chat": {"id": uid, "type": "private"},
+            "from": self._user(uid),
+        }
+        if contact is not None:
+            # Телефон приходит кнопкой «Отправить номер»
+            data["contact"] = {"phone_number": contact, "first_name": f"U{uid}", "user_id": uid}
+            return Update.de_json({"update_id": self.update_id, "message": data}, self.app.bot)
+        data["text"] = text
+        if text.startswith("/"):
+            data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": self.update_id, "message": data}, self.app.bot)
+
+    def callback(self, uid, payload):
+        return Update.de_json({
+            "update_id": self._next_id(),
+            "callback_query": {
+                "id": str(self.update_id),
+                "chat_instance": str(uid),
+                "data": payload,
+                "from": self._user(uid),
+                "message": {
+                    "message_id": 1,
+                    "date": 0,
+                    "chat": {"id": uid, "type": "private"},
+                    "from": BOT_USER,
+                    "text": "",
+                },
+            },
+        }, self.app.bot)
+
+    async def send(self, step, update):
+        # Как в Application: апдейт идёт через процессор параллельности
+        async def handle():
+            started = perf_counter()
+            await self.app.process_update(update)
+            self.latencies.setdefault(step, []).append(perf_counter() - started)
+
+        arrived = perf_counter()
+        await self.app.update_processor.process_update(update, handle())
+        self.waits.setdefault(step, []).append(perf_counter() - arrived)
+
+    def buttons(self, uid, prefix):
+        markup = self.transport.markups.get(uid) or {}
+        return [
+            b["callback_data"]
+            for row in markup.get("inline_keyboard", [])
+            for b in row
+            if b.get("callback_data", "").startswith(prefix)
+        ]
+
+    async def client(self, uid, bot, cancel_share):
+        await self.send("start", self.message(uid, "/start"))
+        await self.send("book", self.callback(uid, bot.cb("b")))
+        if len(bot.masters) > 1:
+            await self.send("master", self.callback(uid, random.choice(self.buttons(uid, bot.cb("m", "")))))
+        # Одна-две услуги: записи разной длины, на несколько слотов
+        for s in random.sample(bot.SERVICES, random.choice((1, 1, 2))):
+            await self.send("service", self.callback(uid, bot.cb("s", s["id"])))
+        await self.send("service", self.callback(uid, bot.cb("sd")))
+
+        dates = self.buttons(uid, bot.cb("d", ""))
+        if not dates:
+            self.outcomes["no_free_dates"] += 1
+            return
+        await self.send("date", self.callback(uid, random.choice(dates)))
+        times = self.buttons(uid, bot.cb("t", ""))
+        if not times:
+            self.outcomes["no_free_times"] += 1
+            return
+        await self.send("time", self.callback(uid, random.choice(times)))
+        await self.send("name", self.message(uid, f"Клиент {uid}"))
+        await self.send("phone", self.message(uid, contact=f"+99890{uid:07d}"))
+        await self.send("confirm", self.callback(uid, bot.cb("cb")))
+
+        cancels = self.buttons(uid, bot.cb("c", ""))
+        if not cancels:
+            self.outcomes["slot_taken"] += 1
+            return
+        self.outcomes["booked"] += 1
+        if random.random() < cancel_share:
+            await self.send("cancel", self.callback(uid, cancels[0]))
+            self.outcomes["cancelled"] += 1
+
+    async def admin(self, bot, views):
+        for _ in range(views):
+            await self.send("admin_bookings", self.message(ADMIN_ID, "/bookings all"))
+            pages = self.buttons(ADMIN_ID, bot.cb("ap", ""))
+            if pages:
+                await self.send("admin_page", self.callback(ADMIN_ID, pages[0]))
+            await asyncio.sleep(0)
+
+
+def seed_bookings(bot, existing):
+    # Уже сделанные записи: не плотнее половины слотов, чтобы клиентам было куда записаться
+    rng = random.Random(0)
+    for m in bot.masters.values():
+        per_day = len(m.slots)
+        horizon = max(bot.DAYS_AHEAD, 2 * existing // per_day + 1)
+        slots = [(d, t) for d in range(1, horizon + 1) for t in m.slots]
+        chosen = rng.sample(slots, min(existing, len(slots) // 2))
+        today = date.today()
+        data = [{
+            "id": 10**12 + i,
+            "master": m.id,
+            "user_id": str(10**6 + i),
+            "name": f"Гость {i}",
+            "phone": f"+99891{i:07d}",
+            "services": [bot.SERVICES[i % len(bot.SERVICES)]["name"]],
+            "date": (today + timedelta(days=d)).isoformat(),
+            "time": t,
+            "status": "confirmed",
+            "created": today.isoformat(),
+        } for i, (d, t) in enumerate(chosen)]
+        bot.save_bookings(data, m)
+        m.store.backend.close()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def double_bookings(bot, bookings):
+    # Пересекающиеся подтверждённые записи одного мастера в один день
+    days = {}
+    for b in bookings:
+        if b.get("status") == "confirmed":
+            m = bot.masters[b.get("master")]
+            days.setdefault((m.id, b.get("date")), []).append(bot.booking_span(b, m.interval))
+    overlaps = 0
+    for spans in days.values():
+        spans.sort()
+        end = -1
+        for s, e in spans:
+            if s < end:
+                overlaps += 1
+            end = max(end, e)
+    return overlaps
+
+
+def duplicate_ids(bookings):
+    ids = Counter(b.get("id") for b in bookings)
+    return sum(n - 1 for n in ids.values() if n > 1)
+
+
+async def run(bot, args):
+    transport = FakeTransport(args.api_latency / 1000)
+    app = (
+        Application.builder()
+        .bot(Bot("1:BENCH", request=transport, get_updates_request=transport))
+        .concurrent_updates(bot.PerChatUpdateProcessor(args.concurrency))
+        .build()
+    )
+    bot.register_handlers(app)
+    await app.initialize()
+    await bot.on_startup(app)
+
+    sim = Simulation(app, transport)
+    users = [10_000 + i for i in range(args.users)]
+    started = perf_counter()
+    await asyncio.gather(
+        sim.admin(bot, args.admin_views),
+        *(sim.client(uid, bot, args.cancel_share) for uid in users),
+    )
+    elapsed = perf_counter() - started
+
+    live = [b for m in bot.masters.values() for b in m.store.bookings]
+    await bot.on_shutdown(app)
+    await app.shutdown()
+
+    # Перечитываем с диска: двойные записи проверяем и в памяти, и в хранилище
+    on_disk = []
+    for m in bot.masters.values():
+        fresh = bot.BookingStore(bot.make_storage(m), m.slots, m.interval)
+        fresh.load()
+        on_disk.append(fresh.bookings)
+        fresh.backend.close()
+    return sim, transport, elapsed, live, on_disk
+
+
+def report(bot, args, sim, transport, elapsed, live, on_disk):
+    updates = sum(len(v) for v in sim.waits.values())
+    print(f"backend={args.backend} users={args.users} existing={args.existing} "
+          f"concurrency={args.concurrency} api-latency={args.api_latency}ms")
+    print(f"updates: {updates} за {elapsed:.2f}s — {updates / elapsed:.0f} updates/s, "
+          f"{sim.outcomes['booked'] / elapsed:.1f} записей/s")
+    print("исходы: " + ", ".join(f"{k}={v}" for k, v in sorted(sim.outcomes.items())))
+
+    # p50/p95/p99 — время обработчиков; e2e p99 — вместе с ожиданием места в процессоре
+    print(f"\n{'step':<15} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'e2e p99':>8}")
+    handled, waited = [], []
+    rows = [(step, values, sim.waits.get(step, [])) for step, values in sim.latencies.items()]
+    for step, values, waits in rows:
+        handled.extend(values)
+        waited.extend(waits)
+    for step, values, waits in rows + [("all", handled, waited)]:
+        print(f"{step:<15} {len(values):>6} " + " ".join(
+            f"{percentile(values, p) * 1000:>8.2f}" for p in (50, 95, 99)
+        ) + f" {percentile(waits, 99) * 1000:>8.2f}")
+
+    written = {dict(labels)["file"]: value for (name, labels), value in bot.metrics.counters.items()
+               if name == "bot_storage_bytes_written_total"}
+    print("\nзаписано байт: " + (", ".join(f"{k}={v}" for k, v in sorted(written.items())) or "0")
+          + f" (всего {sum(written.values())})")
+    print("вызовы Bot API: " + ", ".join(f"{k}={v}" for k, v in transport.calls.most_common()))
+
+    errors = {dict(labels)["error"]: value for (name, labels), value in bot.metrics.counters.items()
+              if name == "bot_errors_total"}
+    print("ошибки обработчиков: " + (", ".join(f"{k}={v}" for k, v in sorted(errors.items())) or "нет"))
+    throttled = Counter()
+    for (name, labels), value in bot.metrics.counters.items():
+        if name == "bot_updates_throttled_total":
+            throttled[dict(labels)["reason"]] += value
+    print("отклонено лимитами: " + (", ".join(f"{k}={v}" for k, v in sorted(throttled.items())) or "нет"))
+
+    doubles_live = double_bookings(bot, live)
+    doubles_disk = sum(double_bookings(bot, b) for b in on_disk)
+    dup_ids = sum(duplicate_ids(b) for b in on_disk)
+    print(f"двойные записи: в памяти {doubles_live}, на диске {doubles_disk}; повторы id: {dup_ids}")
+    return doubles_live + doubles_disk + dup_ids + sum(errors.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=300, help="клиентов, проходящих запись одновременно")
+    parser.add_argument("--existing", type=int, default=1000, help="уже сделанных записей на мастера")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--cancel-share", type=float, default=0.2, help="доля клиентов, отменяющих запись")
+    parser.add_argument("--admin-views", type=int, default=20, help="сколько раз админ открывает /bookings")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # bot.py читает настройки из окружения при импорте и пишет файлы в текущий каталог
+    os.environ.update(BOT_TOKEN="1:BENCH", ADMIN_ID=str(ADMIN_ID), STORAGE_BACKEND=args.backend)
+    os.chdir(tempfile.mkdtemp(prefix="zapis-load-"))
+    import bot
+    if not args.verbose:
+        # Ошибки обработчиков всё равно видны в отчёте — по счётчику bot_errors_total
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+    seed_bookings(bot, args.existing)
+    bot.metrics.counters.clear()
+    bot.metrics.histograms.clear()
+    bot.load_state()
+
+    problems = report(bot, args, *asyncio.run(run(bot, args)))
+    print(f"\nфайлы: {os.getcwd()}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
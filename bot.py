@@ -1,7 +1,25 @@
+import asyncio
+import bisect
+import csv
+import gc
+import heapq
 import json
 import logging
+import mmap
 import os
+import queue
+import signal
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import traceback
+from collections import Counter, deque
+from contextlib import contextmanager
 from datetime import datetime, date, time, timedelta
+from functools import lru_cache, partial, wraps
+from time import monotonic
 
 from telegram import (
     Update,
@@ -10,11 +28,15 @@ from telegram import (
     KeyboardButton,
     ReplyKeyboardMarkup,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
@@ -24,240 +46,3030 @@ BOT_TOKEN = os.environ.get('BOT_TOKEN', '')  # Из переменных окр
 ADMIN_ID = int(os.environ.get('ADMIN_ID', '0'))
 MASTER_NAME = "Ден"
 
-# Проверка токена
-if not BOT_TOKEN:
-    logging.error("❌ BOT_TOKEN not set! Please set environment variable.")
-    exit(1)
+# Режим работы: polling (по умолчанию) или webhook
+RUN_MODE = os.environ.get('RUN_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')        # публичный https-адрес бота
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+PORT = int(os.environ.get('PORT', '8080'))
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))  # /metrics в режиме polling (0 — выключено)
 
-if not ADMIN_ID:
-    logging.error("❌ ADMIN_ID not set! Please set environment variable.")
-    exit(1)
+# Профилирование медленных апдейтов
+PROFILE_SLOW_UPDATES = os.environ.get('PROFILE_SLOW_UPDATES', '') == '1'
+SLOW_UPDATE_SEC = float(os.environ.get('SLOW_UPDATE_SEC', '1.0'))
+PROFILE_INTERVAL_SEC = 0.01  # шаг сэмплирования стека
 
-WORK_START = (10, 0)   # 10:00
+WORK_START = (10, 0)   # 10:00  (график по умолчанию, если у мастера не задан свой)
 WORK_END = (22, 0)     # 22:00
 INTERVAL_MIN = 45      # шаг 45 минут
 DAYS_AHEAD = 7         # даты на 7 дней
+HOLD_TTL_SEC = 600     # слот держится 10 минут, пока клиент вводит имя и телефон
+WAITLIST_MAX = 5       # занятых слотов, которые клиент может ждать одновременно
+ADMIN_PAGE_SIZE = 10   # записей на странице /bookings
+MY_BOOKINGS_MAX = 10   # предстоящих записей в /my
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '32'))  # апдейтов разных чатов одновременно
+# Token bucket на пользователя: тип апдейта -> (токенов в секунду, ёмкость).
+# "*" — все апдейты пользователя вместе, "msg" — сообщения, остальное — коды кнопок
+RATE_LIMITS = {
+    "*": (3, 20),
+    "msg": (1, 8),
+    "s": (4, 12),
+    "d": (1, 6),
+    "t": (1, 6),
+    "cb": (0.2, 3),
+    "c": (0.5, 4),
+    "mc": (0.5, 4),
+}
+SHED_PENDING = CONCURRENT_UPDATES * 8  # столько апдейтов в работе — отбрасываем навигацию
+SHED_KEEP = {"cb", "c", "mc"}          # кнопки, которые не отбрасываются под нагрузкой
 
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')  # json | sqlite
 DATA_FILE = "bookings.json"
+SQLITE_FILE = os.environ.get('SQLITE_FILE', 'bookings.db')
+JOURNAL_FILE = "bookings.journal.jsonl"
+# Формат снимка журнала: binary — bookings.snap (см. write_snapshot_file), json — bookings.json
+SNAPSHOT_FORMAT = os.environ.get('SNAPSHOT_FORMAT', 'binary')
+SNAPSHOT_FILE = "bookings.snap"
+COMPACT_EVERY = 500     # сворачивать журнал в снимок каждые N событий
+STORAGE_COMMIT_WINDOW_MS = 2    # сколько поток записи добирает операции в одну пачку
+STORAGE_COMMIT_MAX_OPS = 256    # и не больше стольких операций в пачке
+ARCHIVE_DIR = "archive"     # прошедшие и отменённые записи, по файлу на месяц
+ARCHIVE_EVERY_SEC = 3600    # как часто переносить их из живого хранилища
+HISTORY_TEXT_LIMIT = 3500   # максимальная длина ответа /history
+REMINDER_HOURS = (24, 2)    # напоминания клиенту за столько часов до визита
+STATS_FILE = "stats.json"   # агрегаты для /stats
+STATS_FLUSH_SEC = 60        # как часто сбрасывать их на диск
+
+# Очередь уведомлений
+OUTBOX_FILE = "outbox.jsonl"
+OUTBOX_GLOBAL_RATE = 25     # сообщений в секунду на бота (лимит Telegram — 30)
+OUTBOX_CHAT_RATE = 1        # сообщений в секунду в один чат
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_DIGEST_LIMIT = 3500  # максимальная длина сводки для админа
+EDIT_COALESCE_SEC = 0.3     # правки одного сообщения за это окно уходят одной
+
+# Незаконченные записи переживают перезапуск
+FLOW_STATE_FILE = "flows.db"
+FLOW_FLUSH_SEC = 2          # как часто сбрасывать изменившиеся состояния
+FLOW_STATE_TTL = 24 * 3600  # старше — не восстанавливаем
 
 # Услуги
 SERVICES = [
-    {"id": 1, "name": "Мужская стрижка", "price": "80,000 сум"},
-    {"id": 2, "name": "Борода", "price": "50,000 сум"},
-    {"id": 3, "name": "Стрижка + укладка", "price": "100,000 сум"},
-    {"id": 4, "name": "Окрашивание волос", "price": "150,000 сум"},
+    {"id": 1, "name": "Мужская стрижка", "price": 80000, "icon": "💇", "duration": 45},
+    {"id": 2, "name": "Борода", "price": 50000, "icon": "🧔", "duration": 30},
+    {"id": 3, "name": "Стрижка + укладка", "price": 100000, "icon": "✂️", "duration": 60},
+    {"id": 4, "name": "Окрашивание волос", "price": 150000, "icon": "🎨", "duration": 90},
+]
+# price — в сумах; duration — минуты, запись на несколько услуг занимает их суммарное время
+CURRENCY = "сум"
+
+# Мастера: у каждого свой график и своё хранилище записей.
+# Не заданные work_start / work_end / interval берутся из WORK_START / WORK_END / INTERVAL_MIN.
+# Список можно заменить JSON-файлом из MASTERS_FILE (тот же формат).
+MASTERS = [
+    {"id": "den", "name": MASTER_NAME, "work_start": (10, 0), "work_end": (22, 0), "interval": 45},
 ]
+MASTERS_FILE = os.environ.get('MASTERS_FILE', '')
+if MASTERS_FILE:
+    with open(MASTERS_FILE, encoding="utf-8") as f:
+        MASTERS = json.load(f)
+MASTERS_DIR = "masters"  # файлы записей второго и следующих мастеров: masters/<id>/...
+# Каких мастеров обслуживает этот процесс (id через запятую, по умолчанию — всех).
+# Шарды мастеров независимы, поэтому их можно разнести по разным процессам. Апдейты бота
+# Telegram отдаёт только одному получателю, так что у каждого такого процесса свой BOT_TOKEN.
+SERVE_MASTERS = [m for m in os.environ.get('SERVE_MASTERS', '').split(",") if m]
+PROCESS_DIR = "processes"   # очередь уведомлений и незаконченные записи процесса с SERVE_MASTERS
+# id записи = миллисекунды * ID_SHARDS + номер мастера в MASTERS: шарды в разных
+# процессах не выдают одинаковых id
+ID_SHARDS = 100
+
+# ---------------- LOG ----------------
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# ---------------- Metrics ----------------
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_HELP = {
+    "bot_handler_seconds": ("histogram", "Время работы обработчика"),
+    "bot_handler_errors_total": ("counter", "Исключения в обработчиках"),
+    "bot_slow_updates_total": ("counter", "Обработчики дольше SLOW_UPDATE_SEC"),
+    "bot_storage_seconds": ("histogram", "Время операций хранилища"),
+    "bot_storage_bytes_read_total": ("counter", "Прочитано байт хранилищем"),
+    "bot_storage_bytes_written_total": ("counter", "Записано байт хранилищем"),
+    "bot_storage_commits_total": ("counter", "Пачки изменений, записанные потоком записи"),
+    "bot_storage_commit_ops_total": ("counter", "Операции в записанных пачках"),
+    "bot_telegram_api_seconds": ("histogram", "Задержка вызовов Bot API"),
+    "bot_telegram_api_errors_total": ("counter", "Ошибки вызовов Bot API"),
+    "bot_flow_steps_total": ("counter", "Шаги записи, пройденные клиентами"),
+    "bot_errors_total": ("counter", "Ошибки, дошедшие до error_handler"),
+    "bot_callbacks_rejected_total": ("counter", "Нажатия с нераспознанной или неверной callback_data"),
+    "bot_edits_skipped_total": ("counter", "Правки сообщений, не отправленные в Telegram"),
+    "bot_updates_throttled_total": ("counter", "Апдейты, отклонённые лимитами или при перегрузке"),
+    "bot_update_queue": ("gauge", "Апдейты в очереди"),
+    "bot_outbox_pending": ("gauge", "Неотправленные уведомления"),
+    "bot_reminders_scheduled": ("gauge", "Запланированные напоминания"),
+    "bot_active_bookings": ("gauge", "Активные записи"),
+    "bot_slot_holds": ("gauge", "Закреплённые слоты"),
+}
+
+class Metrics:
+    """Счётчики и гистограммы в текстовом формате Prometheus.
+
+    Пишут в них и цикл событий, и рабочие потоки хранилища, поэтому
+    обновления идут под замком — он берётся на доли микросекунды.
+    """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [по корзинам..., sum, count]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self, gauges=None):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {METRICS_HELP.get(name, (kind, name))[1]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), h in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), h):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {h[-1]}")
+        for (name, labels), value in sorted((gauges or {}).items()):
+            header(name, "gauge")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class SlowUpdateProfiler:
+    """Сэмплирующий профайлер медленных апдейтов.
+
+    Фоновый поток каждые PROFILE_INTERVAL_SEC проверяет, нет ли
+    обработчика, работающего дольше SLOW_UPDATE_SEC, и если есть —
+    снимает стек потока цикла событий (это работает и когда обработчик
+    заблокировал цикл). Когда такой обработчик завершается, самые
+    частые стеки пишутся в лог. Включается PROFILE_SLOW_UPDATES=1.
+    """
+
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self.inflight = {}  # token -> (handler, started)
+        self.samples = {}   # token -> Counter стеков
+        self.loop_thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def begin(self, name):
+        token = object()
+        self.inflight[token] = (name, monotonic())
+        return token
+
+    def end(self, token):
+        name, started = self.inflight.pop(token)
+        with self._lock:
+            samples = self.samples.pop(token, None)
+        if samples:
+            top = "\n".join(f"  {count} × {stack}" for stack, count in samples.most_common(3))
+            logger.warning("Медленный апдейт %s: %.2fs, частые стеки:\n%s", name, monotonic() - started, top)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            now = monotonic()
+            slow = [token for token, (_, started) in list(self.inflight.items()) if now - started >= self.threshold]
+            frame = sys._current_frames().get(self.loop_thread)
+            if not slow or frame is None:
+                continue
+            stack = " <- ".join(
+                f"{f.name}:{f.lineno}" for f in reversed(traceback.extract_stack(frame, limit=12))
+            )
+            with self._lock:
+                for token in slow:
+                    self.samples.setdefault(token, Counter())[stack] += 1
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self._stopped.clear()
+        threading.Thread(target=self._sample, name="slow-update-profiler", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+profiler = SlowUpdateProfiler(SLOW_UPDATE_SEC, PROFILE_INTERVAL_SEC) if PROFILE_SLOW_UPDATES else None
+
+def timed(handler):
+    # Время обработчика в гистограмму; медленные апдейты — в счётчик и профайлер
+    name = handler.__name__
+
+    @wraps(handler)
+    async def wrapper(update, context, *args):
+        token = profiler.begin(name) if profiler is not None else None
+        started = monotonic()
+        try:
+            return await handler(update, context, *args)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            elapsed = monotonic() - started
+            metrics.observe("bot_handler_seconds", elapsed, handler=name)
+            if elapsed >= SLOW_UPDATE_SEC:
+                metrics.inc("bot_slow_updates_total", handler=name)
+            if token is not None:
+                profiler.end(token)
+
+    return wrapper
+
+def flow_step(step):
+    metrics.inc("bot_flow_steps_total", step=step)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который меряет задержку каждого вызова Bot API."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = monotonic()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_telegram_api_errors_total", method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_telegram_api_seconds", monotonic() - started, method=api_method)
+
+# ---------------- Storage helpers ----------------
+def read_bookings_file(path):
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            metrics.inc("bot_storage_bytes_read_total", os.path.getsize(path), file="snapshot")
+            if isinstance(data, list):
+                return data
+            else:
+                return []
+    except Exception as e:
+        logger.error("Error loading bookings: %s", e)
+        return []
+
+def fsync_dir(path):
+    # После os.replace нужно сбросить и сам каталог, иначе переименование может потеряться
+    if os.name != "posix":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write_json(path, data, file="snapshot", **dump_kwargs):
+    # file — метка в bot_storage_bytes_written_total
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, **dump_kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+        metrics.inc("bot_storage_bytes_written_total", f.tell(), file=file)
+    os.replace(tmp, path)
+    fsync_dir(path)
+
+def to_minutes(time_str):
+    h, m = time_str.split(":")
+    return int(h) * 60 + int(m)
+
+def booking_span(b, default_duration):
+    # Интервал записи [start, end) в минутах от полуночи. У записей,
+    # сделанных до появления длительностей, её нет — они занимают один слот
+    start = to_minutes(b.get("time"))
+    return start, start + int(b.get("duration") or default_duration)
+
+# Бинарный снимок: заголовок, таблица строк (даты, статусы, мастера, услуги — каждая
+# строка один раз), записи фиксированной длины и JSON-хвосты с остальными полями.
+# При загрузке из записи сразу берутся только поля для индексов; хвост остаётся
+# байтами и разбирается при первом обращении (LazyBooking).
+SNAPSHOT_MAGIC = b"ZSNP"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sHIII")   # magic, версия, записей, строк, байт в таблице строк
+# id, user_id, date, time (минуты), duration, status, master, 4 услуги, 4 id услуг, price,
+# маска горячих полей, ушедших в хвост, смещение и длина хвоста
+SNAPSHOT_RECORD = struct.Struct("<qqIHHHH4H4HiHII")
+# Версия 1 (без id услуг и маски) читается по-прежнему
+SNAPSHOT_RECORD_V1 = struct.Struct("<qqIHHHH4HiII")
+NO_ID = -2**63
+NO_STR = 0xFFFF
+NO_SERVICES = 0xFFFE    # в первом слоте услуг (и их id): у записи нет этого поля
+NO_DATE = 0xFFFFFFFF
+HOT_BITS = {key: 1 << i for i, key in enumerate((
+    "id", "user_id", "date", "time", "duration", "status", "master", "services", "service_ids", "price",
+))}
+HOT_FIELDS = frozenset(HOT_BITS)
+TAIL_UNKNOWN = 0xFFFF   # маска неизвестна (снимок версии 1): любое отсутствующее поле ищем в хвосте
+
+def tail_mask(keys):
+    return sum(HOT_BITS[k] for k in keys if k in HOT_BITS)
+
+class LazyBooking(dict):
+    """Запись из бинарного снимка: поля для индексов — сразу, остальное — при первом обращении.
+
+    Горячего поля нет в записи — его нет и в хвосте, если маска tail этого
+    не говорит: у старых записей (без duration, service_ids, master) такие
+    проверки хвост не разбирают.
+    """
+
+    __slots__ = ("_cold", "_tail")
+
+    def __init__(self, hot, cold, tail=TAIL_UNKNOWN):
+        dict.__init__(self, hot)
+        self._cold = cold   # байты JSON с остальными полями или None
+        self._tail = tail   # горячие поля, лежащие в хвосте (биты HOT_BITS)
+
+    def _load(self):
+        cold = self._cold
+        if cold:
+            for key, value in json.loads(cold).items():
+                # Поля, изменённые до разбора (отмена), новее снимка
+                dict.setdefault(self, key, value)
+        # Хвост убираем последним: другой поток, копирующий запись для снимка (при остановке),
+        # видит либо хвост, либо уже все поля
+        self._cold = None
+
+    def _need(self, key):
+        if (self._cold is not None and not dict.__contains__(self, key)
+                and self._tail & HOT_BITS.get(key, TAIL_UNKNOWN)):
+            self._load()
+
+    def __getitem__(self, key):
+        self._need(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._need(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        self._need(key)
+        return dict.__contains__(self, key)
+
+    def __delitem__(self, key):
+        self._need(key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self._need(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        self._need(key)
+        return dict.setdefault(self, key, default)
+
+    # Всё, что обходит запись целиком (dict(b), json.dumps, сравнение), сначала её разбирает
+    def _full(self):
+        if self._cold is not None:
+            self._load()
+        return self
+
+    def __iter__(self):
+        return dict.__iter__(self._full())
+
+    def __len__(self):
+        return dict.__len__(self._full())
+
+    def __eq__(self, other):
+        return dict.__eq__(self._full(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return dict.__repr__(self._full())
+
+    def keys(self):
+        return dict.keys(self._full())
+
+    def values(self):
+        return dict.values(self._full())
+
+    def items(self):
+        return dict.items(self._full())
+
+    def copy(self):
+        return dict(self.items())
+
+    def popitem(self):
+        return dict.popitem(self._full())
+
+    def snapshot_copy(self):
+        # Копия для снимка без разбора хвоста: он уйдёт в файл теми же байтами
+        copy = LazyBooking((), self._cold, self._tail)
+        dict.update(copy, dict.items(self))
+        return copy
+
+def snapshot_copy(b):
+    return b.snapshot_copy() if isinstance(b, LazyBooking) else dict(b)
+
+def _encode_record(b, strings):
+    # -> (поля записи без смещения хвоста, байты хвоста)
+    def intern(value, limit=NO_SERVICES):
+        index = strings.setdefault(value, len(strings))
+        if index >= limit:
+            raise ValueError("snapshot string table is full")
+        return index
+
+    if isinstance(b, LazyBooking) and b._cold is not None:
+        hot, cold, tail = dict(dict.items(b)), b._cold, b._tail
+        if not hot.keys() <= HOT_FIELDS:
+            # После загрузки добавились холодные поля — разбираем и пишем заново
+            hot, cold = dict(b.items()), None
+        elif tail == TAIL_UNKNOWN:
+            # Запись из снимка версии 1: маску узнаём по ключам хвоста, сам хвост пишем как есть
+            tail = tail_mask(json.loads(cold))
+    else:
+        hot, cold = dict(b), None
+    rest = {k: v for k, v in hot.items() if k not in HOT_FIELDS}
+
+    def is_int(v, low, high):
+        return isinstance(v, int) and not isinstance(v, bool) and low <= v < high
+
+    def take(key, check):
+        # Поле, не влезающее в фиксированную запись, уходит в хвост
+        if key not in hot:
+            return False
+        if check(hot[key]):
+            return True
+        rest[key] = hot[key]
+        return False
+
+    bid = hot["id"] if take("id", lambda v: is_int(v, NO_ID + 1, 2**63)) else NO_ID
+    # user_id хранится числом, только если строка из него восстанавливается без потерь
+    uid = int(hot["user_id"]) if take("user_id", lambda v: isinstance(v, str) and v.isascii() and v.isdigit()
+                                      and len(v) < 19 and str(int(v)) == v) else -1
+    day = intern(hot["date"], NO_DATE) if take("date", lambda v: isinstance(v, str)) else NO_DATE
+    tm = NO_STR
+    if take("time", lambda v: isinstance(v, str) and len(v) == 5 and v[2] == ":" and v.isascii()
+            and (v[:2] + v[3:]).isdigit() and int(v[3:]) < 60):
+        tm = to_minutes(hot["time"])
+    duration = hot["duration"] if take("duration", lambda v: is_int(v, 1, NO_STR)) else 0
+    status = intern(hot["status"]) if take("status", lambda v: isinstance(v, str)) else NO_STR
+    master = intern(hot["master"]) if take("master", lambda v: isinstance(v, str)) else NO_STR
+    services = [NO_SERVICES] + [NO_STR] * 3
+    if take("services", lambda v: isinstance(v, list) and len(v) <= 4 and all(isinstance(x, str) for x in v)):
+        services = [NO_STR] * 4
+        for i, name in enumerate(hot["services"]):
+            services[i] = intern(name)
+    service_ids = [NO_SERVICES] + [NO_STR] * 3
+    if take("service_ids", lambda v: isinstance(v, list) and len(v) <= 4
+            and all(is_int(x, 0, NO_SERVICES) for x in v)):
+        service_ids = [NO_STR] * 4
+        for i, sid in enumerate(hot["service_ids"]):
+            service_ids[i] = sid
+    price = hot["price"] if take("price", lambda v: is_int(v, 0, 2**31)) else -1
+
+    if cold is not None and rest:
+        # Горячее поле после загрузки получило значение, которое не влезает в запись
+        rest = {**json.loads(cold), **rest}
+        cold = None
+    if cold is None:
+        tail = tail_mask(rest)
+        cold = json.dumps(rest, ensure_ascii=False, separators=(",", ":")).encode("utf-8") if rest else b""
+    return (bid, uid, day, tm, duration, status, master, *services, *service_ids, price, tail), cold
+
+def write_snapshot_file(path, records):
+    strings = {}
+    fixed = []
+    blobs = []
+    offset = 0
+    for b in records:
+        fields, cold = _encode_record(b, strings)
+        fixed.append(SNAPSHOT_RECORD.pack(*fields, offset, len(cold)))
+        blobs.append(cold)
+        offset += len(cold)
+    table = b"".join(struct.pack("<H", len(raw)) + raw for raw in (value.encode("utf-8") for value in strings))
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(fixed), len(strings), len(table))
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(header)
+        f.write(table)
+        f.write(b"".join(fixed))
+        f.write(b"".join(blobs))
+        f.flush()
+        os.fsync(f.fileno())
+        metrics.inc("bot_storage_bytes_written_total", f.tell(), file="snapshot")
+    os.replace(tmp, path)
+    fsync_dir(path)
+
+def read_snapshot_file(path):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, version, count, n_strings, table_len = SNAPSHOT_HEADER.unpack_from(mm, 0)
+        if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_VERSION):
+            raise ValueError(f"Unknown snapshot format in {path}")
+        record = SNAPSHOT_RECORD if version == SNAPSHOT_VERSION else SNAPSHOT_RECORD_V1
+        pos = SNAPSHOT_HEADER.size
+        strings = []
+        for _ in range(n_strings):
+            (size,) = struct.unpack_from("<H", mm, pos)
+            strings.append(mm[pos + 2:pos + 2 + size].decode("utf-8"))
+            pos += 2 + size
+        records_end = pos + count * record.size
+        blobs = records_end
+        times = {}
+        services = {}
+        service_ids = {}
+        records = []
+        view = memoryview(mm)
+        # Сотни тысяч новых словарей подряд запускают сборщик мусора впустую: циклов здесь нет
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            rows = record.iter_unpack(view[pos:records_end])
+            if version == 1:
+                rows = (row[:11] + (NO_SERVICES, NO_STR, NO_STR, NO_STR, row[11], TAIL_UNKNOWN) + row[12:]
+                        for row in rows)
+            for (bid, uid, day, tm, duration, status, master, s1, s2, s3, s4,
+                    i1, i2, i3, i4, price, tail, off, size) in rows:
+                hot = {}
+                if bid != NO_ID:
+                    hot["id"] = bid
+                if uid >= 0:
+                    hot["user_id"] = str(uid)
+                if day != NO_DATE:
+                    hot["date"] = strings[day]
+                if tm != NO_STR:
+                    hot["time"] = times.get(tm) or times.setdefault(tm, f"{tm // 60:02d}:{tm % 60:02d}")
+                if duration:
+                    hot["duration"] = duration
+                if status != NO_STR:
+                    hot["status"] = strings[status]
+                if master != NO_STR:
+                    hot["master"] = strings[master]
+                if s1 != NO_SERVICES:
+                    key = (s1, s2, s3, s4)
+                    names = services.get(key)
+                    if names is None:
+                        names = services[key] = [strings[i] for i in key if i != NO_STR]
+                    hot["services"] = names.copy()
+                if i1 != NO_SERVICES:
+                    key = (i1, i2, i3, i4)
+                    ids = service_ids.get(key)
+                    if ids is None:
+                        ids = service_ids[key] = [i for i in key if i != NO_STR]
+                    hot["service_ids"] = ids.copy()
+                if price >= 0:
+                    hot["price"] = price
+                records.append(LazyBooking(hot, mm[blobs + off:blobs + off + size] if size else None, tail))
+        finally:
+            view.release()
+            if gc_enabled:
+                gc.enable()
+        metrics.inc("bot_storage_bytes_read_total", len(mm), file="snapshot")
+    return records
+
+# Бэкенды хранения. Общий интерфейс:
+#   load() -> list             все записи при старте
+#   commit(ops) -> list        пачка изменений одной записью на диск, результат на каждую операцию:
+#     ("insert", booking)      True или False, если время уже занято (другим процессом)
+#     ("cancel", bookings)     записи уже помечены отменёнными в памяти
+#     ("evict", bookings)      записи ушли в архив и уже убраны из памяти
+#   replace_all(bookings)      полная перезапись (save_bookings)
+#   overlapping(date, start, end)  подтверждённые записи, пересекающие интервал
+#   compaction_due             журнал пора свернуть: BookingStore передаст копию памяти в start_compaction(records)
+#   close() / aclose()
+# После старта бота все вызовы, кроме load(), идут из потока StorageWriter.
+# Ошибки записи (STORAGE_ERRORS) не глотаются: BookingStore откатывает память.
+STORAGE_ERRORS = (OSError, sqlite3.Error)
+
+class JournalStorage:
+    """Снимок (bookings.snap или bookings.json) плюс журнал событий в JSONL.
+
+    Каждое изменение дописывает в журнал одну строку; когда журнал
+    разрастается, он сворачивается в новый снимок в фоне. Сам журнал
+    снимок не собирает: records общий с BookingStore и может опережать
+    диск, поэтому он только выставляет compaction_due.
+    """
+
+    def __init__(self, path, journal_path, snap_path=None):
+        self.path = path
+        self.snap_path = snap_path or os.path.splitext(path)[0] + ".snap"
+        self.journal_path = journal_path
+        self.records = []
+        self._journal = None
+        self._journal_events = 0
+        self._journal_size = None   # до какой длины обрезать журнал после неудачной записи
+        self._segment_seq = 0
+        self._compaction = None     # поток, пишущий последний снимок
+        self.compaction_due = False
+
+    def load(self):
+        self.records = self._read_snapshot()
+        ids = {b.get("id") for b in self.records}
+        # Сначала недосвёрнутые сегменты (если упали во время сжатия), потом текущий журнал
+        for seg in self._segments():
+            self._replay(seg, ids)
+        self._trim_torn_tail()
+        self._journal_events = self._replay(self.journal_path, ids)
+        return self.records
+
+    def _read_snapshot(self):
+        # Формат могли переключить (SNAPSHOT_FORMAT) — читаем более свежий из двух снимков
+        found = [(os.path.getmtime(p), p) for p in (self.snap_path, self.path) if os.path.exists(p)]
+        if not found:
+            return []
+        path = max(found)[1]
+        if path != self.snap_path:
+            return read_bookings_file(path)
+        try:
+            return read_snapshot_file(path)
+        except (ValueError, struct.error) as e:
+            logger.error("Error loading bookings: %s", e)
+            return []
+
+    def _trim_torn_tail(self):
+        # Если упали посреди записи, обрезаем недописанную строку, иначе следующая склеится с ней
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb+") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.seek(0)
+                data = f.read()
+                logger.warning("Обрезана недописанная строка журнала %s", self.journal_path)
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def _segments(self):
+        prefix = os.path.basename(self.journal_path) + "."
+        folder = os.path.dirname(os.path.abspath(self.journal_path))
+        segments = []
+        for name in os.listdir(folder):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit():
+                segments.append((int(suffix), os.path.join(folder, name)))
+        segments.sort()
+        if segments:
+            self._segment_seq = max(self._segment_seq, segments[-1][0])
+        return [p for _, p in segments]
+
+    def _replay(self, path, ids):
+        if not os.path.exists(path):
+            return 0
+        by_id = {b.get("id"): b for b in self.records}
+        count = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Оборванная последняя строка после падения — просто пропускаем
+                    logger.warning("Пропущена повреждённая строка журнала в %s", path)
+                    continue
+                count += 1
+                # Воспроизведение идемпотентно: событие могло уже попасть в снимок
+                if event.get("op") == "created":
+                    b = event["booking"]
+                    if b.get("id") not in ids:
+                        ids.add(b.get("id"))
+                        self.records.append(b)
+                        by_id[b.get("id")] = b
+                elif event.get("op") == "cancelled":
+                    b = by_id.get(event.get("id"))
+                    if b is not None:
+                        b["status"] = "cancelled"
+                        b["cancelled_at"] = event.get("at")
+                        b["cancelled_by"] = event.get("by")
+        metrics.inc("bot_storage_bytes_read_total", os.path.getsize(path), file="journal")
+        return count
+
+    def commit(self, ops):
+        events = []
+        evicted = False
+        for op, arg in ops:
+            if op == "insert":
+                # Запись уже лежит в self.records (общий список с BookingStore)
+                events.append({"op": "created", "booking": arg})
+            elif op == "cancel":
+                events.extend(
+                    {"op": "cancelled", "id": b.get("id"), "by": b.get("cancelled_by"), "at": b.get("cancelled_at")}
+                    for b in arg
+                )
+            elif op == "evict":
+                # В памяти их уже нет: следующий снимок просто не будет их содержать
+                evicted = True
+        if events:
+            self._append(events)
+        if evicted:
+            # Вытесненных записей нет в журнале — убрать их с диска может только новый снимок
+            self.compaction_due = True
+        # Журнал пишет только этот процесс — занять время раньше нас некому
+        return [True if op == "insert" else None for op, _ in ops]
+
+    def replace_all(self, bookings):
+        self.records = bookings
+        self.compact()
+
+    def overlapping(self, date_iso, start, end):
+        # Журнал пишет только этот процесс, всё актуальное уже в памяти
+        return []
+
+    def _append(self, events):
+        # Пачка событий — одна запись и один fsync
+        self._repair_journal()
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        before = self._journal.tell()
+        try:
+            self._journal.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in events))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        except OSError:
+            # Пачка могла лечь на диск целиком или частью, но сохранённой её не считают — убираем её
+            # из журнала. Иначе следующая пачка склеится с обрывком и пропадёт при воспроизведении,
+            # а отклонённая запись вернётся после перезапуска
+            try:
+                self._journal.close()
+            except OSError:
+                pass
+            self._journal = None
+            self._journal_size = before
+            try:
+                self._repair_journal()
+            except OSError as e:
+                logger.error("Не удалось обрезать журнал %s, запись в него остановлена: %s", self.journal_path, e)
+            raise
+        metrics.inc("bot_storage_bytes_written_total", self._journal.tell() - before, file="journal")
+        self._journal_events += len(events)
+        if self._journal_events >= COMPACT_EVERY:
+            self.compaction_due = True
+
+    def _repair_journal(self):
+        # Пока журнал не обрезан до последней подтверждённой пачки, дописывать в него нельзя
+        if self._journal_size is None:
+            return
+        with open(self.journal_path, "rb+") as f:
+            f.truncate(self._journal_size)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_size = None
+        logger.warning("Журнал %s обрезан до последней сохранённой пачки", self.journal_path)
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _rotate_journal(self):
+        # Текущий журнал становится сегментом, новые события пишутся в чистый файл
+        self._repair_journal()
+        self._close_journal()
+        self._journal_events = 0
+        if not os.path.exists(self.journal_path):
+            return
+        self._segment_seq += 1
+        os.replace(self.journal_path, f"{self.journal_path}.{self._segment_seq}")
+        fsync_dir(self.journal_path)
+
+    def _write_snapshot(self, records, segments):
+        write_start = datetime.now()
+        with metrics.timer("bot_storage_seconds", op="snapshot", backend="json"):
+            if SNAPSHOT_FORMAT == "binary":
+                write_snapshot_file(self.snap_path, records)
+            else:
+                atomic_write_json(self.path, records, indent=2)
+        # Снимок на месте — сегменты, вошедшие в него, больше не нужны
+        for seg in segments:
+            try:
+                os.remove(seg)
+            except FileNotFoundError:
+                # Их уже удалил предыдущий снимок
+                pass
+        logger.info("Журнал свёрнут: %d записей за %s", len(records), datetime.now() - write_start)
+
+    def start_compaction(self, records):
+        # Выполняется в потоке записи между пачками. records — копия памяти, в которой ровно то,
+        # что уже в журнале, поэтому ротация здесь и есть граница снимка. Тяжёлая запись — в
+        # отдельном потоке; если предыдущий снимок ещё пишется, новый дождётся его там же
+        self._rotate_journal()
+        self._compaction = threading.Thread(
+            target=self._compact_in_thread, args=(self._compaction, records, self._segments()),
+            name="journal-compaction", daemon=True,
+        )
+        self._compaction.start()
+
+    def _compact_in_thread(self, previous, records, segments):
+        if previous is not None:
+            previous.join()
+        try:
+            self._write_snapshot(records, segments)
+        except Exception as e:
+            logger.error("Error compacting bookings journal: %s", e)
+
+    def compact(self):
+        # Синхронно, из памяти как есть: при перезаписи и остановке, когда очередь записи пуста
+        if self._compaction is not None:
+            self._compaction.join()
+        self.compaction_due = False
+        try:
+            self._rotate_journal()
+            self._write_snapshot([snapshot_copy(b) for b in self.records], self._segments())
+        except Exception as e:
+            logger.error("Error compacting bookings journal: %s", e)
+
+    def close(self):
+        if self._compaction is not None:
+            self._compaction.join()
+        if self._journal_events or self.compaction_due:
+            self.compact()
+        self._close_journal()
+
+    async def aclose(self):
+        await asyncio.to_thread(self.close)
+
+class SqliteStorage:
+    """SQLite в режиме WAL.
+
+    Бронирование — одна транзакция BEGIN IMMEDIATE: проверка пересечения
+    с подтверждёнными записями дня и вставка идут под блокировкой записи,
+    поэтому два клиента, нажавшие «Подтвердить» одновременно, не получат
+    пересекающееся время. Уникальный индекс по (date, time) остаётся
+    страховкой для одинакового начала.
+    """
+
+    compaction_due = False  # снимков нет, WAL сворачивает сам SQLite
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            status TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_bookings_date ON bookings(date, time);
+        CREATE INDEX IF NOT EXISTS idx_bookings_user ON bookings(user_id);
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_bookings_confirmed_slot
+            ON bookings(date, time) WHERE status = 'confirmed';
+    """
+
+    def __init__(self, path, default_duration=INTERVAL_MIN):
+        self.path = path
+        self.default_duration = default_duration
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            # Открывается при загрузке в главном потоке, дальше работает поток StorageWriter
+            self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=FULL")
+            self.db.execute("PRAGMA busy_timeout=5000")
+            self.db.executescript(self.SCHEMA)
+        return self.db
+
+    @staticmethod
+    def _row(b):
+        return (b.get("id"), b.get("user_id"), b.get("date"), b.get("time"), b.get("status"),
+                json.dumps(b, ensure_ascii=False))
+
+    @staticmethod
+    def _count_written(rows, data_col):
+        metrics.inc("bot_storage_bytes_written_total", sum(len(r[data_col].encode("utf-8")) for r in rows), file="sqlite")
+
+    def load(self):
+        rows = self._connect().execute("SELECT data FROM bookings ORDER BY id").fetchall()
+        metrics.inc("bot_storage_bytes_read_total", sum(len(data.encode("utf-8")) for (data,) in rows), file="sqlite")
+        return [json.loads(data) for (data,) in rows]
+
+    def commit(self, ops):
+        # Вся пачка — одна транзакция BEGIN IMMEDIATE
+        results = []
+        written = []
+        db = self._connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            for op, arg in ops:
+                if op == "insert":
+                    row = self._row(arg)
+                    inserted = self._insert(db, arg, row)
+                    if inserted:
+                        written.append(row[5])
+                    results.append(inserted)
+                elif op == "cancel":
+                    rows = [(b.get("status"), json.dumps(b, ensure_ascii=False), b.get("id")) for b in arg]
+                    db.executemany("UPDATE bookings SET status = ?, data = ? WHERE id = ?", rows)
+                    written.extend(r[1] for r in rows)
+                    results.append(None)
+                elif op == "evict":
+                    db.executemany("DELETE FROM bookings WHERE id = ?", ((b.get("id"),) for b in arg))
+                    results.append(None)
+        self._count_written([(data,) for data in written], 0)
+        return results
+
+    def _insert(self, db, booking, row):
+        start, end = booking_span(booking, self.default_duration)
+        if self._overlapping(db, booking["date"], start, end):
+            return False
+        # Отказ одной вставки (уникальный индекс) не должен откатывать остальную пачку
+        db.execute("SAVEPOINT booking")
+        try:
+            db.execute(
+                "INSERT INTO bookings (id, user_id, date, time, status, data) VALUES (?, ?, ?, ?, ?, ?)",
+                row,
+            )
+        except sqlite3.IntegrityError:
+            db.execute("ROLLBACK TO booking")
+            return False
+        finally:
+            db.execute("RELEASE booking")
+        return True
+
+    def _overlapping(self, db, date_iso, start, end):
+        # Записей на день — десяток, интервалы сравниваем прямо здесь
+        found = []
+        for (data,) in db.execute(
+            "SELECT data FROM bookings WHERE date = ? AND status = 'confirmed'", (date_iso,)
+        ):
+            b = json.loads(data)
+            b_start, b_end = booking_span(b, self.default_duration)
+            if b_start < end and start < b_end:
+                found.append(b)
+        return found
+
+    def import_bookings(self, bookings):
+        db = self._connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO bookings (id, user_id, date, time, status, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (self._row(b) for b in bookings),
+            )
+            return db.total_changes - before
+
+    def replace_all(self, bookings):
+        rows = [self._row(b) for b in bookings]
+        self._count_written(rows, 5)
+        db = self._connect()
+        try:
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute("DELETE FROM bookings")
+                db.executemany(
+                    "INSERT INTO bookings (id, user_id, date, time, status, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+        except sqlite3.Error as e:
+            logger.error("Error saving bookings: %s", e)
+
+    def overlapping(self, date_iso, start, end):
+        return self._overlapping(self._connect(), date_iso, start, end)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    async def aclose(self):
+        self.close()
+
+def make_storage(master, backend=None):
+    backend = backend or STORAGE_BACKEND
+    if backend == "sqlite":
+        return SqliteStorage(master.file(SQLITE_FILE), master.interval)
+    if backend == "json":
+        return JournalStorage(master.file(DATA_FILE), master.file(JOURNAL_FILE), master.file(SNAPSHOT_FILE))
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+def migrate_json_to_sqlite(json_path=DATA_FILE, db_path=SQLITE_FILE, interval=INTERVAL_MIN):
+    records = JournalStorage(json_path, json_path.replace(".json", ".journal.jsonl")).load()
+    # Старый код мог записать двоих на один слот — оставляем первую запись,
+    # остальные переносим отменёнными, чтобы не потерять и не нарушить уникальность
+    seen = set()
+    for b in records:
+        if b.get("status") != "confirmed":
+            continue
+        key = (b.get("date"), b.get("time"))
+        if key in seen:
+            logger.warning("Двойная запись на %s %s: #%s перенесена как отменённая", key[0], key[1], b.get("id"))
+            b["status"] = "cancelled"
+            b["cancelled_by"] = "migration"
+            b["cancelled_at"] = datetime.now().isoformat()
+        seen.add(key)
+
+    target = SqliteStorage(db_path, interval)
+    imported = target.import_bookings(records)
+    target.close()
+    logger.info("✅ Перенесено записей в %s: %d из %d", db_path, imported, len(records))
+
+def _settle(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class StorageWriter:
+    """Поток записи бэкенда с групповым коммитом.
+
+    BookingStore меняет память сразу, а изменение для диска ставит в
+    очередь и ждёт только своё подтверждение, не занимая цикл событий.
+    Поток берёт операцию, добирает всё, что пришло за
+    STORAGE_COMMIT_WINDOW_MS, и отдаёт пачку бэкенду одним commit(): в
+    журнале это одна запись и один fsync, в SQLite — одна транзакция.
+    Пока идёт fsync, в очереди копится следующая пачка.
+    """
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self._queue = queue.SimpleQueue()   # (операция, аргумент, цикл, future) или None — остановка
+        self._thread = None
+        self.inflight = 0   # операции, чьё подтверждение ещё не вернулось в цикл событий
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"storage-{self.name}", daemon=True)
+            self._thread.start()
+
+    async def stop(self):
+        # Очередь дописывается до конца, потом поток выходит
+        if self._thread is not None:
+            self._queue.put(None)
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def submit(self, op, arg=None):
+        # op — операция commit() или функция без аргументов, которую надо выполнить в потоке записи
+        if self._thread is None:
+            # Поток не запущен (скрипты, перенос данных) — пишем сразу
+            return self._execute([(op, arg)])[0]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.inflight += 1
+        try:
+            self._queue.put((op, arg, loop, future))
+            return await future
+        finally:
+            self.inflight -= 1
+
+    async def call(self, fn, *args):
+        return await self.submit(partial(fn, *args))
+
+    def post(self, fn):
+        # Без ожидания: fn выполнится в потоке записи после всего, что уже в очереди
+        if self._thread is None:
+            fn()
+        else:
+            self._queue.put((fn, None, None, None))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = monotonic() + STORAGE_COMMIT_WINDOW_MS / 1000
+            while len(batch) < STORAGE_COMMIT_MAX_OPS:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Остановка: дописываем то, что уже набрали
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        # Подряд идущие операции — одним commit(), функции — по одной, порядок сохраняется
+        i = 0
+        while i < len(batch):
+            j = i + 1
+            if isinstance(batch[i][0], str):
+                while j < len(batch) and isinstance(batch[j][0], str):
+                    j += 1
+            group = batch[i:j]
+            try:
+                results, error = self._execute([(op, arg) for op, arg, _, _ in group]), None
+            except Exception as e:
+                logger.error("Error saving bookings: %s", e)
+                results, error = [None] * len(group), e
+            for (_, _, loop, future), result in zip(group, results):
+                if future is not None:
+                    loop.call_soon_threadsafe(_settle, future, result, error)
+            i = j
+
+    def _execute(self, ops):
+        if callable(ops[0][0]):
+            return [ops[0][0]()]
+        with metrics.timer("bot_storage_seconds", op="commit", backend=STORAGE_BACKEND):
+            results = self.backend.commit(ops)
+        metrics.inc("bot_storage_commits_total")
+        metrics.inc("bot_storage_commit_ops_total", len(ops))
+        return results
+
+class BookingStore:
+    """Резидентное хранилище записей.
+
+    Записи читаются из бэкенда один раз при старте, дальше все проверки
+    идут по индексу интервалов: для каждого дня — отсортированный список
+    (start, end, id) подтверждённых записей в минутах. Подтверждённые
+    интервалы не пересекаются, поэтому пересечение с новым проверяется
+    одним бинарным поиском и одним соседом слева.
+    Маски недоступных стартов сетки для выбора даты и времени считаются
+    по этому индексу и кэшируются до изменения дня.
+    Подтверждённые записи также лежат в списке, отсортированном по
+    (date, time, id): страница админки — это срез по бинарному поиску.
+    Так же по клиентам: у каждого user_id свой отсортированный список,
+    и его предстоящие записи (/my) — срез от сегодняшнего дня.
+    Изменения сначала проверяются и применяются к памяти (без await —
+    значит, атомарно для цикла событий), потом add/cancel ждут
+    подтверждения записи от StorageWriter. Если запись на диск не
+    удалась, память откатывается, а ошибка уходит обработчику.
+    """
+
+    def __init__(self, backend, time_slots, interval=INTERVAL_MIN, name="store"):
+        self.backend = backend
+        self.writer = StorageWriter(backend, name)
+        self.interval = interval
+        self.slot_index = {t: i for i, t in enumerate(time_slots)}
+        self.starts = [to_minutes(t) for t in time_slots]
+        # Последний слот сетки — последнее время начала, день заканчивается через интервал после него
+        self.day_end = self.starts[-1] + interval if self.starts else 0
+        self.bookings = []
+        self.days = {}      # date -> отсортированные (start, end, id) подтверждённых записей
+        self.masks = {}     # date -> {duration: маска стартов, где запись не помещается}
+        self.by_date = []   # отсортированные (date, time, id) подтверждённых записей
+        self.active = {}    # id -> подтверждённая запись
+        self.by_user = {}   # user_id -> отсортированные (date, time, id) его подтверждённых записей
+        self.max_id = 0     # наибольший id среди загруженных и добавленных записей
+        self.listeners = [] # fn(event, booking), event — "confirmed" | "cancelled"
+
+    def _timer(self, op):
+        return metrics.timer("bot_storage_seconds", op=op, backend=STORAGE_BACKEND)
+
+    def load(self):
+        with self._timer("load"):
+            self.bookings = self.backend.load()
+        self.reindex()
+        logger.info("Загружено записей: %d (активных: %d)", len(self.bookings), len(self.active))
+
+    def reindex(self):
+        self.days = {}
+        self.masks = {}
+        self.active = {}
+        self.by_user = {}
+        for b in self.bookings:
+            self._index(b, sort=False)
+        for day in self.days.values():
+            day.sort()
+        for keys in self.by_user.values():
+            keys.sort()
+        self.by_date = sorted((b.get("date"), b.get("time"), b.get("id")) for b in self.active.values())
+        self.max_id = max((b.get("id") for b in self.bookings if isinstance(b.get("id"), int)), default=0)
+
+    def span(self, b):
+        return booking_span(b, self.interval)
+
+    def _index(self, b, sort=True):
+        if b.get("status") == "confirmed":
+            start, end = self.span(b)
+            day = self.days.setdefault(b.get("date"), [])
+            if sort:
+                bisect.insort(day, (start, end, b.get("id")))
+            else:
+                day.append((start, end, b.get("id")))
+            self.masks.pop(b.get("date"), None)
+            self.active[b.get("id")] = b
+            entry = (b.get("date"), b.get("time"), b.get("id"))
+            mine = self.by_user.setdefault(str(b.get("user_id")), [])
+            if sort:
+                bisect.insort(self.by_date, entry)
+                bisect.insort(mine, entry)
+            else:
+                mine.append(entry)
+
+    def _unindex(self, b):
+        if self.active.pop(b.get("id"), None) is not None:
+            start, end = self.span(b)
+            day = self.days.get(b.get("date"), [])
+            pos = bisect.bisect_left(day, (start, end, b.get("id")))
+            if pos < len(day) and day[pos][2] == b.get("id"):
+                del day[pos]
+            self.masks.pop(b.get("date"), None)
+            entry = (b.get("date"), b.get("time"), b.get("id"))
+            for keys in (self.by_date, self.by_user.get(str(b.get("user_id")), [])):
+                pos = bisect.bisect_left(keys, entry)
+                if pos < len(keys) and keys[pos] == entry:
+                    del keys[pos]
+
+    def overlaps(self, date_iso, start, end):
+        day = self.days.get(date_iso)
+        if not day:
+            return False
+        # Последний интервал, начавшийся раньше end: он же заканчивается позже всех предыдущих
+        pos = bisect.bisect_left(day, (end,))
+        return pos > 0 and day[pos - 1][1] > start
+
+    def fits(self, date_iso, start, duration):
+        return start + duration <= self.day_end and not self.overlaps(date_iso, start, start + duration)
+
+    def busy_mask(self, date_iso, duration=None):
+        # Бит i — с time_slots[i] запись такой длительности начать нельзя
+        duration = duration or self.interval
+        cached = self.masks.setdefault(date_iso, {})
+        mask = cached.get(duration)
+        if mask is None:
+            mask = 0
+            for i, start in enumerate(self.starts):
+                if not self.fits(date_iso, start, duration):
+                    mask |= 1 << i
+            cached[duration] = mask
+        return mask
+
+    def free_count(self, date_iso, duration=None):
+        return len(self.starts) - self.busy_mask(date_iso, duration).bit_count()
+
+    def find(self, bid):
+        return self.active.get(bid)
+
+    def upcoming(self, user_id, date_from, time_from="", limit=None):
+        # Подтверждённые записи клиента, начиная с date_from time_from, не больше limit
+        keys = self.by_user.get(str(user_id), [])
+        lo = bisect.bisect_left(keys, (date_from, time_from))
+        hi = len(keys) if limit is None else lo + limit
+        return [self.active[key[2]] for key in keys[lo:hi]]
+
+    def page(self, date_from, date_to=None, offset=0, limit=None):
+        # Подтверждённые записи с date_from по date_to (не включая), срез [offset, offset+limit)
+        lo = bisect.bisect_left(self.by_date, (date_from,))
+        hi = bisect.bisect_left(self.by_date, (date_to,)) if date_to else len(self.by_date)
+        end = hi if limit is None else min(hi, lo + offset + limit)
+        return [self.active[key[2]] for key in self.by_date[lo + offset:end]], hi - lo
+
+    async def add(self, booking):
+        start, end = self.span(booking)
+        if end > self.day_end or self.overlaps(booking["date"], start, end):
+            return False
+        # Сначала в память: следующие подтверждения уже видят это время занятым
+        self.bookings.append(booking)
+        self._index(booking)
+        self.max_id = max(self.max_id, booking["id"])
+        try:
+            inserted = await self._insert(booking, start, end)
+        finally:
+            self._compact_if_due()
+        if inserted:
+            self._emit("confirmed", booking)
+        return inserted
+
+    async def _insert(self, booking, start, end):
+        try:
+            with self._timer("insert"):
+                # Копия: пока поток записи сериализует запись, её могут уже отменять
+                inserted = await self.writer.submit("insert", dict(booking))
+        except Exception:
+            self._forget(booking)
+            raise
+        if not inserted:
+            # Время успел занять другой процесс — откатываемся и подтягиваем его записи
+            self._forget(booking)
+            for theirs in await self.writer.call(self.backend.overlapping, booking["date"], start, end):
+                if theirs.get("id") not in self.active:
+                    self.bookings.append(theirs)
+                    self._index(theirs)
+        return inserted
+
+    def _forget(self, booking):
+        self._unindex(booking)
+        # Новая запись — в конце списка; сравнение по id(), а не ==, не разбирает ленивые записи
+        for i in range(len(self.bookings) - 1, -1, -1):
+            if self.bookings[i] is booking:
+                del self.bookings[i]
+                break
+
+    async def cancel(self, booking, by):
+        await self.cancel_many([booking], by)
+
+    async def cancel_many(self, bookings, by):
+        now = datetime.now().isoformat()
+        saved = []
+        for b in bookings:
+            saved.append({k: b[k] for k in ("status", "cancelled_at", "cancelled_by") if k in b})
+            self._unindex(b)
+            b["status"] = "cancelled"
+            b["cancelled_at"] = now
+            b["cancelled_by"] = by
+        try:
+            with self._timer("cancel"):
+                await self.writer.submit("cancel", [dict(b) for b in bookings])
+        except Exception:
+            for b, fields in zip(bookings, saved):
+                for k in ("status", "cancelled_at", "cancelled_by"):
+                    b.pop(k, None)
+                b.update(fields)
+                if b.get("status") != "confirmed":
+                    continue
+                start, end = self.span(b)
+                if self.fits(b.get("date"), start, end - start):
+                    self._index(b)
+                else:
+                    logger.error("Запись #%s не отменена на диске, но её время уже занято", b.get("id"))
+            raise
+        finally:
+            self._compact_if_due()
+        for b in bookings:
+            self._emit("cancelled", b)
+
+    def _emit(self, event, booking):
+        for fn in self.listeners:
+            try:
+                fn(event, booking)
+            except Exception as e:
+                logger.error("Booking listener failed: %s", e)
+
+    def cold(self, today):
+        # Прошедшие и отменённые — кандидаты в архив
+        return [b for b in self.bookings if b.get("status") != "confirmed" or b.get("date", "") < today]
+
+    async def evict(self, bookings):
+        evicted = {id(b) for b in bookings}
+        for b in bookings:
+            self._unindex(b)
+        # Список общий с бэкендом журнала — меняем на месте
+        self.bookings[:] = [b for b in self.bookings if id(b) not in evicted]
+        try:
+            with self._timer("evict"):
+                await self.writer.submit("evict", bookings)
+        finally:
+            self._compact_if_due()
+
+    def _compact_if_due(self):
+        # Снимок журнала собирается только из того, что уже на диске. Пока хоть одна операция
+        # ждёт подтверждения, память опережает журнал (и ещё может откатиться) — свернём позже.
+        # Когда ждать нечего, копия памяти совпадает с журналом, а ротация встаёт в очередь
+        # сразу за ней: всё, что придёт дальше, попадёт уже в новый журнал
+        if not self.backend.compaction_due or self.writer.inflight:
+            return
+        self.backend.compaction_due = False
+        records = [snapshot_copy(b) for b in self.bookings]
+        self.writer.post(partial(self.backend.start_compaction, records))
+
+    def save(self):
+        # Полная перезапись — только пока поток записи не запущен (подготовка данных, скрипты)
+        if self.writer.running:
+            raise RuntimeError("BookingStore.save() while the storage writer is running")
+        with self._timer("replace_all"):
+            self.backend.replace_all(self.bookings)
+
+    async def aclose(self):
+        await self.writer.stop()
+        await self.backend.aclose()
+
+# ---------------- Archive ----------------
+class Archive:
+    """Холодные записи мастера: прошедшие и отменённые.
+
+    Лежат по файлу на месяц даты визита (ГГГГ-ММ.jsonl) и читаются только
+    по запросу — для истории и отчётов. Файлы только дописываются; если
+    запись попала в архив дважды (упали до вычистки из живого хранилища),
+    при чтении побеждает последняя строка.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, month):
+        return os.path.join(self.folder, f"{month}.jsonl")
+
+    def months(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(name[:-len(".jsonl")] for name in os.listdir(self.folder) if name.endswith(".jsonl"))
+
+    def append(self, bookings):
+        # Выполняется в рабочем потоке, не в цикле событий
+        os.makedirs(self.folder, exist_ok=True)
+        by_month = {}
+        for b in bookings:
+            by_month.setdefault(str(b.get("date", ""))[:7] or "undated", []).append(b)
+        for month, items in by_month.items():
+            data = "".join(json.dumps(b, ensure_ascii=False) + "\n" for b in items).encode("utf-8")
+            with open(self.path(month), "a+b") as f:
+                # Недописанная строка после падения не должна склеиться с новой
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        data = b"\n" + data
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            metrics.inc("bot_storage_bytes_written_total", len(data), file="archive")
+        fsync_dir(self.path("_"))
+
+    def read(self, month):
+        path = self.path(month)
+        if not os.path.exists(path):
+            return []
+        by_id = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    b = json.loads(line)
+                except ValueError:
+                    continue
+                by_id[b.get("id")] = b
+        metrics.inc("bot_storage_bytes_read_total", os.path.getsize(path), file="archive")
+        return list(by_id.values())
+
+    def query(self, date_from, date_to=None):
+        # Записи с date_from по date_to (не включая); читаются только нужные месяцы
+        for month in self.months():
+            if month < date_from[:7] or (date_to and month > date_to[:7]):
+                continue
+            for b in self.read(month):
+                if date_from <= b.get("date", "") and (not date_to or b.get("date", "") < date_to):
+                    yield b
+
+class Archiver:
+    """Фоновый перенос холодных записей из живых хранилищ в архив.
+
+    Сначала копии записей дописываются в архив в рабочем потоке, потом
+    записи убираются из памяти и бэкенда. Если запись успели изменить,
+    пока писался архив, она остаётся до следующего прохода.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._task = None
+
+    async def archive(self, master):
+        store = master.store
+        cold = [(b, b.get("status")) for b in store.cold(date.today().isoformat())]
+        if not cold:
+            return 0
+        await asyncio.to_thread(master.archive.append, [dict(b) for b, _ in cold])
+        # Отбор и удаление из памяти — без await между ними, параллельная отмена не вклинится
+        moved = [b for b, status in cold if b.get("status") == status]
+        await store.evict(moved)
+        return len(moved)
+
+    async def run(self):
+        while True:
+            for m in masters.values():
+                try:
+                    moved = await self.archive(m)
+                    if moved:
+                        logger.info("В архив перенесено записей (%s): %d", m.id, moved)
+                except Exception as e:
+                    logger.error("Error archiving bookings: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+archiver = Archiver(ARCHIVE_EVERY_SEC)
+
+# ---------------- Analytics ----------------
+SERVICE_BY_ID = {s["id"]: s for s in SERVICES}
+SERVICE_BY_NAME = {s["name"]: s for s in SERVICES}
+
+def format_price(amount):
+    return f"{amount:,} {CURRENCY}"
+
+def booking_service_ids(b):
+    # Старые записи хранят только названия услуг
+    if "service_ids" in b:
+        return b["service_ids"]
+    return [SERVICE_BY_NAME[name]["id"] for name in b.get("services", []) if name in SERVICE_BY_NAME]
+
+def booking_price(b):
+    if "price" in b:
+        return b["price"]
+    return sum(SERVICE_BY_ID[sid]["price"] for sid in booking_service_ids(b))
+
+class Stats:
+    """Агрегаты мастера: записи, отмены, выручка и занятые минуты.
+
+    Счётчики по дням, месяцам, услугам и часу начала меняются на каждом
+    подтверждении и отмене (слушатель BookingStore), поэтому /stats не
+    читает ни записи, ни архив. На диск снимок уходит раз в STATS_FLUSH_SEC,
+    а при остановке — с отметкой clean. При старте отметка сразу
+    снимается: если бота убили или он упал, изменения после последнего
+    сброса в файл не попали, и агрегаты пересчитываются по архиву и живым
+    записям (как и без файла).
+    """
+
+    FIELDS = ("bookings", "cancelled", "revenue", "minutes")
+
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+        self.total = self._zero()
+        self.days = {}      # "ГГГГ-ММ-ДД" -> счётчики
+        self.months = {}    # "ГГГГ-ММ" -> счётчики
+        self.services = {}  # str(id услуги) -> счётчики
+        self.hours = {}     # "10" -> счётчики записей, начинающихся в этот час
+        self.dirty = False
+
+    @classmethod
+    def _zero(cls):
+        return dict.fromkeys(cls.FIELDS, 0)
+
+    def _apply(self, b, confirmed, cancelled):
+        # confirmed: +1 — запись подтверждена, -1 — подтверждённую отменили
+        start, end = self.store.span(b)
+        day = b.get("date", "")
+        delta = (confirmed, cancelled, confirmed * booking_price(b), confirmed * (end - start))
+        buckets = [
+            self.total,
+            self.days.setdefault(day, self._zero()),
+            self.months.setdefault(day[:7], self._zero()),
+            self.hours.setdefault(str(start // 60), self._zero()),
+        ]
+        for bucket in buckets:
+            for field, value in zip(self.FIELDS, delta):
+                bucket[field] += value
+        for sid in booking_service_ids(b):
+            service = SERVICE_BY_ID.get(sid)
+            bucket = self.services.setdefault(str(sid), self._zero())
+            bucket["bookings"] += confirmed
+            bucket["cancelled"] += cancelled
+            if service is not None:
+                bucket["revenue"] += confirmed * service["price"]
+                bucket["minutes"] += confirmed * service["duration"]
+        self.dirty = True
+
+    def on_booking(self, event, b):
+        if event == "confirmed":
+            self._apply(b, 1, 0)
+        elif event == "cancelled":
+            self._apply(b, -1, 1)
+
+    def range(self, date_from, date_to):
+        # Сумма по дням [date_from, date_to) — не больше нескольких десятков словарей
+        out = self._zero()
+        day, end = date.fromisoformat(date_from), date.fromisoformat(date_to)
+        while day < end:
+            for field, value in self.days.get(day.isoformat(), {}).items():
+                out[field] += value
+            day += timedelta(days=1)
+        return out
+
+    def capacity(self, days):
+        # Рабочих минут мастера за столько дней
+        return days * (self.store.day_end - self.store.starts[0]) if self.store.starts else 0
+
+    def load(self, archive):
+        if not os.path.exists(self.path):
+            self.rebuild(archive)
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            clean = data.get("clean", False)
+            if clean:
+                self.total = data["total"]
+                self.days, self.months = data["days"], data["months"]
+                self.services, self.hours = data["services"], data["hours"]
+        except (ValueError, KeyError) as e:
+            logger.error("Error loading stats, recounting: %s", e)
+            self.__init__(self.path, self.store)
+            clean = None
+        if not clean:
+            if clean is False:
+                logger.warning("Статистика не была сохранена при остановке — пересчитываем")
+            self.rebuild(archive)
+            return
+        # Снимаем отметку: до следующей штатной остановки файл может отставать
+        self.save()
+
+    def rebuild(self, archive):
+        # Архив читается помесячно: в памяти не больше одного месяца
+        live_ids = {b.get("id") for b in self.store.bookings}
+        for month in archive.months():
+            for b in archive.read(month):
+                if b.get("id") not in live_ids:
+                    self._count(b)
+        for b in self.store.bookings:
+            self._count(b)
+        logger.info("Статистика пересчитана: записей %d, отмен %d", self.total["bookings"], self.total["cancelled"])
+        self.save()
+
+    def _count(self, b):
+        # Итог уже известен: отменённая запись когда-то была подтверждена и снята
+        if b.get("status") == "confirmed":
+            self._apply(b, 1, 0)
+        else:
+            self._apply(b, 0, 1)
+
+    def snapshot(self, clean=False):
+        # Копия для записи в рабочем потоке: счётчики в это время продолжают меняться.
+        # clean — последний сброс при штатной остановке, после него изменений не будет
+        self.dirty = False
+
+        def copy(table):
+            return {key: dict(value) for key, value in table.items()}
+
+        return {
+            "total": dict(self.total),
+            "days": copy(self.days),
+            "months": copy(self.months),
+            "services": copy(self.services),
+            "hours": copy(self.hours),
+            "clean": clean,
+        }
+
+    def save(self):
+        atomic_write_json(self.path, self.snapshot(), file="stats")
+
+class StatsWriter:
+    """Периодический сброс изменившихся агрегатов всех мастеров на диск."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._task = None
+
+    async def flush(self, clean=False):
+        for m in masters.values():
+            if m.stats.dirty or clean:
+                try:
+                    await asyncio.to_thread(atomic_write_json, m.stats.path, m.stats.snapshot(clean), "stats")
+                except Exception as e:
+                    m.stats.dirty = True
+                    logger.error("Error saving stats: %s", e)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(clean=True)
+
+stats_writer = StatsWriter(STATS_FLUSH_SEC)
+
+EXPORT_FIELDS = (
+    "id", "master", "date", "time", "duration", "status", "service_ids", "services", "price",
+    "name", "phone", "user_id", "created", "cancelled_at", "cancelled_by",
+)
+
+def csv_text(value):
+    # Имя и телефон вводит клиент: "=..." в Excel стало бы формулой
+    value = str(value or "")
+    return "'" + value if value[:1] in ("=", "+", "-", "@") else value
+
+def export_row(master, b):
+    start, end = master.store.span(b)
+    return [
+        b.get("id"), master.id, b.get("date"), b.get("time"), end - start, b.get("status"),
+        " ".join(str(sid) for sid in booking_service_ids(b)), csv_text("; ".join(b.get("services", []))),
+        booking_price(b), csv_text(b.get("name")), csv_text(b.get("phone")), b.get("user_id"),
+        b.get("created"), b.get("cancelled_at", ""), b.get("cancelled_by", ""),
+    ]
+
+def export_csv(master, live, date_from, date_to, path):
+    # Выполняется в рабочем потоке. Строки пишутся по одной: архив читается
+    # помесячно, живые записи за период переданы копией
+    live_ids = {b.get("id") for b in live}
+    count = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_FIELDS)
+        for b in master.archive.query(date_from, date_to):
+            # Пока архиватор не вычистил запись, она есть и там, и там
+            if b.get("id") not in live_ids:
+                writer.writerow(export_row(master, b))
+                count += 1
+        for b in live:
+            writer.writerow(export_row(master, b))
+            count += 1
+    return count
+
+# ---------------- Slot holds ----------------
+class SlotHolds:
+    """Временное закрепление времени за клиентом на время ввода имени и телефона.
+
+    Удержание — интервал [start, end) в минутах, как и запись. Истечение
+    держится в min-куче по времени окончания: при каждом обращении
+    снимаются только истёкшие записи с вершины, без прохода по всем
+    удержаниям. Отпущенное или истёкшее удержание передаётся в on_release:
+    время могут ждать по списку ожидания.
+    """
+
+    def __init__(self, ttl, on_release=None):
+        self.ttl = ttl
+        self.on_release = on_release    # (date, start, end) — время снова свободно
+        self.holds = {}     # date -> {start: (user_id, expires_at, end)}
+        self.by_user = {}   # user_id -> (date, start)
+        self._heap = []     # (expires_at, date, start, user_id)
+
+    def __len__(self):
+        return sum(len(day) for day in self.holds.values())
+
+    def _drop(self, date_iso, start):
+        day = self.holds[date_iso]
+        del day[start]
+        if not day:
+            del self.holds[date_iso]
+
+    def _released(self, freed):
+        if self.on_release is not None:
+            for interval in freed:
+                self.on_release(*interval)
+
+    def _expire(self):
+        now = monotonic()
+        freed = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, d, start, uid = heapq.heappop(self._heap)
+            # Устаревшие элементы кучи (время отпущено или перехвачено) просто отбрасываем
+            held = self.holds.get(d, {}).get(start)
+            if held is not None and held[:2] == (uid, expires_at):
+                self._drop(d, start)
+                if self.by_user.get(uid) == (d, start):
+                    del self.by_user[uid]
+                freed.append((d, start, held[2]))
+        # Сообщаем уже после чистки кучи: on_release сам смотрит удержания
+        self._released(freed)
+
+    def intervals(self, date_iso):
+        # Удержания дня: (start, end, user_id)
+        self._expire()
+        return [(start, end, uid) for start, (uid, _, end) in self.holds.get(date_iso, {}).items()]
+
+    def blocked(self, date_iso, user_id):
+        # Интервалы дня, закреплённые другими клиентами
+        return [(start, end) for start, end, uid in self.intervals(date_iso) if uid != user_id]
+
+    def held_by_other(self, date_iso, start, end, user_id):
+        return any(s < end and start < e for s, e in self.blocked(date_iso, user_id))
+
+    def mask(self, date_iso, user_id, starts, duration):
+        # Маска стартов сетки, где запись длительности duration задела бы чужое удержание
+        blocked = self.blocked(date_iso, user_id)
+        m = 0
+        if blocked:
+            for i, start in enumerate(starts):
+                end = start + duration
+                if any(s < end and start < e for s, e in blocked):
+                    m |= 1 << i
+        return m
+
+    def hold(self, date_iso, start, end, user_id):
+        if self.held_by_other(date_iso, start, end, user_id):
+            return False
+        # Прежнее удержание клиента отпускаем после того, как закрепили новое, —
+        # иначе общее у них время на мгновение «освободилось» бы для ждущих
+        previous = self._take(user_id)
+        expires_at = monotonic() + self.ttl
+        self.holds.setdefault(date_iso, {})[start] = (user_id, expires_at, end)
+        self.by_user[user_id] = (date_iso, start)
+        heapq.heappush(self._heap, (expires_at, date_iso, start, user_id))
+        # Без таймера истечение заметили бы только при следующем обращении к удержаниям
+        asyncio.get_running_loop().call_later(self.ttl + 1, self._expire)
+        if previous is not None and previous[:2] != (date_iso, start):
+            self._released([previous])
+        return True
+
+    def _take(self, user_id):
+        # Снимает удержание клиента и возвращает его (date, start, end)
+        key = self.by_user.pop(user_id, None)
+        if key is None:
+            return None
+        held = self.holds.get(key[0], {}).get(key[1])
+        if held is None or held[0] != user_id:
+            return None
+        self._drop(*key)
+        return (*key, held[2])
+
+    def release(self, user_id):
+        freed = self._take(user_id)
+        if freed is not None:
+            self._released([freed])
+
+# ---------------- Waitlist ----------------
+class Waitlist:
+    """Клиенты, ждущие освобождения занятого времени.
+
+    Подписки лежат по дням: date -> time -> {user_id: длительность записи},
+    порядок в словаре — порядок подписки. Отмена записи смотрит только
+    свой день, и только времена, которые она задевала. Истечение — как у
+    SlotHolds: min-куча по началу слота, снимаются прошедшие с вершины.
+    """
+
+    def __init__(self):
+        self.days = {}      # date -> {time: {user_id: duration}}
+        self.by_user = {}   # user_id -> {(date, time)}
+        self._heap = []     # ("ГГГГ-ММ-ДД ЧЧ:ММ", date, time)
+
+    def __len__(self):
+        return sum(len(subs) for day in self.days.values() for subs in day.values())
+
+    def _remove(self, date_iso, time_str, user_id):
+        subs = self.days[date_iso][time_str]
+        del subs[user_id]
+        mine = self.by_user[user_id]
+        mine.discard((date_iso, time_str))
+        if not mine:
+            del self.by_user[user_id]
+        if not subs:
+            del self.days[date_iso][time_str]
+            if not self.days[date_iso]:
+                del self.days[date_iso]
+
+    def _expire(self):
+        now = datetime.now().strftime("%Y-%m-%d %H:%M")
+        while self._heap and self._heap[0][0] <= now:
+            _, d, t = heapq.heappop(self._heap)
+            for uid in list(self.days.get(d, {}).get(t, ())):
+                self._remove(d, t, uid)
+
+    def toggle(self, date_iso, time_str, user_id, duration):
+        # True — подписан, False — подписка снята, None — уже ждёт WAITLIST_MAX слотов
+        self._expire()
+        if (date_iso, time_str) in self.by_user.get(user_id, ()):
+            self._remove(date_iso, time_str, user_id)
+            return False
+        if len(self.by_user.get(user_id, ())) >= WAITLIST_MAX:
+            return None
+        day = self.days.setdefault(date_iso, {})
+        if time_str not in day:
+            day[time_str] = {}
+            heapq.heappush(self._heap, (f"{date_iso} {time_str}", date_iso, time_str))
+        day[time_str][user_id] = duration
+        self.by_user.setdefault(user_id, set()).add((date_iso, time_str))
+        return True
+
+    def freed(self, store, holds, date_iso, start, end):
+        # Подписчики, чьё время задевал освобождённый интервал [start, end) и теперь помещается
+        # (не занято записями и чужими удержаниями). Возвращаются по порядку подписки и из
+        # списка ожидания убираются
+        self._expire()
+        # Удержания дня — один раз до прохода: снятие истёкших само сообщает об освободившемся
+        # времени (on_release) и вызывает freed() снова, посреди прохода это недопустимо
+        held = holds.intervals(date_iso)
+        found = []
+        for time_str, subs in list(self.days.get(date_iso, {}).items()):
+            t = to_minutes(time_str)
+            for uid, duration in list(subs.items()):
+                if (t < end and start < t + duration and store.fits(date_iso, t, duration)
+                        and not any(s < t + duration and t < e and holder != uid for s, e, holder in held)):
+                    found.append((uid, time_str))
+                    self._remove(date_iso, time_str, uid)
+        return found
+
+# ---------------- Helpers: dates & times ----------------
+def generate_dates(n=DAYS_AHEAD):
+    today = date.today()
+    return [today + timedelta(days=i) for i in range(1, n+1)]
+
+def generate_times(work_start=WORK_START, work_end=WORK_END, interval=INTERVAL_MIN):
+    times = []
+    cur = datetime.combine(date.today(), time(hour=work_start[0], minute=work_start[1]))
+    end_dt = datetime.combine(date.today(), time(hour=work_end[0], minute=work_end[1]))
+    while cur <= end_dt:
+        times.append(cur.time().strftime("%H:%M"))
+        cur += timedelta(minutes=interval)
+    return times
+
+def from_minutes(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def time_span(time_str, duration):
+    return f"{time_str}–{from_minutes(to_minutes(time_str) + duration)}"
+
+DAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+# ---------------- Masters ----------------
+class Master:
+    """Мастер со своим графиком.
+
+    Записи каждого мастера — отдельный шард: свои файлы (или своя БД)
+    и архив, свой индекс в памяти, свой поток записи (store.writer) и свои
+    удержания слотов. Общего состояния между мастерами нет, поэтому их можно
+    обслуживать в разных процессах (SERVE_MASTERS), у каждого — свой бот.
+    """
+
+    def __init__(self, conf, number=0, legacy=False):
+        self.id = str(conf["id"])
+        self.number = number    # место в MASTERS — младшие цифры id записей
+        if not self.id or "_" in self.id or ":" in self.id:
+            # id попадает в callback_data, где "_" (старый формат) и ":" — разделители
+            raise ValueError(f"Bad master id: {self.id!r}")
+        self.name = conf["name"]
+        self.legacy = legacy
+        # Сетка слотов фиксирована — считаем её один раз
+        self.interval = conf.get("interval", INTERVAL_MIN)
+        self.slots = generate_times(
+            conf.get("work_start", WORK_START),
+            conf.get("work_end", WORK_END),
+            self.interval,
+        )
+        self.store = BookingStore(make_storage(self), self.slots, self.interval, name=self.id)
+        self.holds = SlotHolds(HOLD_TTL_SEC, on_release=self.notify_freed)
+        self.waitlist = Waitlist()
+        self.archive = Archive(self.file(ARCHIVE_DIR))
+        self.stats = Stats(self.file(STATS_FILE), self.store)
+        self.date_caches = {}   # duration -> кэш клавиатуры дат для записей такой длины
+        self._last_ms = 0
+
+    def notify_waitlist(self, event, b):
+        # Любая отмена (клиентом, админом, /delete_, отменой дня) освобождает время ждущим
+        if event != "cancelled":
+            return
+        start, end = self.store.span(b)
+        self.notify_freed(b.get("date"), start, end)
+
+    def notify_freed(self, date_iso, start, end):
+        # Время освободила отмена записи или отпущенное (истёкшее) удержание
+        day = datetime.fromisoformat(date_iso).strftime("%d.%m.%Y")
+        for user_id, time_str in self.waitlist.freed(self.store, self.holds, date_iso, start, end):
+            notify(user_id, f"🔔 Освободилось время {day} {time_str} у мастера {self.name}.\n\n"
+                            f"Успейте записаться: /start")
+
+    def booking_id(self):
+        # Раньше id был просто временем в мс: два подтверждения в одну миллисекунду получали
+        # один id. Теперь миллисекунды строго растут (и не меньше, чем у уже сохранённых записей),
+        # а номер мастера в младших цифрах разводит шарды
+        ms = max(int(datetime.now().timestamp() * 1000), self._last_ms + 1, self.store.max_id // ID_SHARDS + 1)
+        self._last_ms = ms
+        return ms * ID_SHARDS + self.number
+
+    def file(self, filename):
+        # Первый мастер остаётся на прежних файлах — уже сделанные записи подхватываются как есть
+        if self.legacy:
+            return filename
+        folder = os.path.join(MASTERS_DIR, self.id)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, filename)
+
+if len(MASTERS) > ID_SHARDS:
+    raise ValueError(f"Too many masters: at most {ID_SHARDS}")
+masters = {}
+for _i, _conf in enumerate(MASTERS):
+    if not SERVE_MASTERS or str(_conf["id"]) in SERVE_MASTERS:
+        masters[str(_conf["id"])] = Master(_conf, number=_i, legacy=_i == 0)
+if not masters:
+    raise ValueError("No masters to serve: check MASTERS / SERVE_MASTERS")
+
+def process_file(filename):
+    # Очередь уведомлений и незаконченные записи принадлежат процессу, а не мастеру: процессы
+    # с разными SERVE_MASTERS в одной папке не должны переписывать файлы друг друга
+    if not SERVE_MASTERS:
+        return filename
+    folder = os.path.join(PROCESS_DIR, "+".join(sorted(masters)))
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, filename)
+
+def default_master():
+    return next(iter(masters.values()))
+
+def flow_master(context):
+    # Состояния, начатые до появления выбора мастера, относятся к первому мастеру
+    return masters.get(context.user_data.get("master")) or default_master()
+
+SERVICE_DURATION = {s["id"]: s["duration"] for s in SERVICES}
+
+def flow_duration(context):
+    # Суммарная длительность выбранных услуг; без услуг — один слот мастера
+    selected = context.user_data.get("selected_services", [])
+    return sum(SERVICE_DURATION.get(sid, 0) for sid in selected) or flow_master(context).interval
+
+def find_booking(bid):
+    # Активная запись по id среди всех шардов этого процесса
+    for m in masters.values():
+        b = m.store.find(bid)
+        if b is not None:
+            return m, b
+    return None, None
+
+def release_holds(user_id):
+    for m in masters.values():
+        m.holds.release(user_id)
+
+def save_bookings(data, master=None):
+    # Полная перезапись шарда с переиндексацией — для подготовки данных (benchmarks/load_test.py)
+    store = (master or default_master()).store
+    store.bookings = data
+    store.reindex()
+    store.save()
+
+# ---------------- Callback data ----------------
+# callback_data кнопок: "<версия><код>[:<аргумент>...]", например "1s:3" — услуга 3,
+# "1t:1045" — время 10:45. Короткие коды берегут лимит Telegram в 64 байта, а версия
+# позволяет сменить формат, не ломая кнопки в уже отправленных сообщениях.
+CB_VERSION = "1"
+CB_SEP = ":"
+
+def cb(code, *args):
+    return CB_VERSION + CB_SEP.join((code,) + tuple(str(a) for a in args))
+
+# Прежний формат ("svc_3", "cancel_123", "adm_p_den_week_0", ...) остаётся в старых
+# сообщениях — такие кнопки переводим в коды нового
+LEGACY_CALLBACKS = {
+    "book": "b", "svc_done": "sd", "date_full": "df", "busy": "x",
+    "back_start": "bs", "back_services": "bv", "back_dates": "bd",
+    "confirm_book": "cb", "cancel_flow": "cf", "adm_noop": "an",
+}
+LEGACY_PREFIXES = (   # длинные префиксы раньше коротких
+    ("admin_cancel_", "ac"), ("adm_cdayok_", "ay"), ("adm_cday_", "ad"), ("adm_p_", "ap"),
+    ("cancel_", "c"), ("master_", "m"), ("svc_", "s"), ("date_", "d"), ("time_", "t"),
+)
+
+def legacy_admin_args(code, payload):
+    # adm_*_{master}_{...}; в кнопках, отправленных до появления мастеров, id мастера нет
+    mid, _, rest = payload.partition("_")
+    if mid not in masters:
+        mid, rest = default_master().id, payload
+    if code == "ap":
+        flt, _, page = rest.rpartition("_")
+        return [mid, flt, page]
+    return [mid, rest]
+
+def parse_callback(data):
+    # -> (код, [аргументы]); код None — формат не распознан
+    if data.startswith(CB_VERSION):
+        code, *args = data[len(CB_VERSION):].split(CB_SEP)
+        return code, args
+    code = LEGACY_CALLBACKS.get(data)
+    if code is not None:
+        return code, []
+    for prefix, code in LEGACY_PREFIXES:
+        if data.startswith(prefix):
+            payload = data[len(prefix):]
+            if code in ("ap", "ad", "ay"):
+                return code, legacy_admin_args(code, payload)
+            return code, [payload]
+    return None, []
+
+# Проверка аргументов: значение в нужном типе или ValueError / KeyError
+def arg_int(value):
+    number = int(value)
+    if number < 0:
+        raise ValueError(value)
+    return number
+
+def arg_master(value):
+    return masters[value]
+
+def arg_service(value):
+    sid = int(value)
+    if sid not in SERVICE_DURATION:
+        raise ValueError(value)
+    return sid
+
+def arg_date(value):
+    return date.fromisoformat(value).isoformat()
+
+def arg_time(value):
+    # "1045" (новый формат) или "10:45" (старый)
+    digits = value.replace(":", "")
+    if len(digits) != 4 or not digits.isdigit():
+        raise ValueError(value)
+    return time(int(digits[:2]), int(digits[2:])).strftime("%H:%M")
+
+def arg_filter(value):
+    return value if value in ADMIN_FILTERS else arg_date(value)
+
+# ---------------- Keyboard cache ----------------
+# Объекты разметки PTB неизменяемые, поэтому одни и те же экземпляры
+# безопасно отдавать во все сообщения вместо сборки на каждый callback.
+SERVICE_BIT = {s["id"]: 1 << i for i, s in enumerate(SERVICES)}
+BACK_TO_SERVICES_ROW = [InlineKeyboardButton("🔙 Назад", callback_data=cb("bv"))]
 
-# ---------------- LOG ----------------
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+def build_services_keyboard(mask):
+    kb = []
+    for s in SERVICES:
+        prefix = "✅" if mask & SERVICE_BIT[s["id"]] else s["icon"]
+        kb.append([InlineKeyboardButton(f"{prefix} {s['name']} — {format_price(s['price'])}", callback_data=cb("s", s["id"]))])
+    kb.append([InlineKeyboardButton("✅ Готово", callback_data=cb("sd"))])
+    kb.append([InlineKeyboardButton("🔙 Отмена", callback_data=cb("bs"))])
+    return InlineKeyboardMarkup(kb)
 
-# ---------------- Storage helpers ----------------
-def load_bookings():
-    if not os.path.exists(DATA_FILE):
-        return []
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, list):
-                return data
-            else:
-                return []
-    except Exception as e:
-        logger.error("Error loading bookings: %s", e)
-        return []
+# Вариантов выбора услуг всего 2^len(SERVICES) — строим все сразу
+SERVICE_KEYBOARDS = [build_services_keyboard(mask) for mask in range(1 << len(SERVICES))]
 
-def save_bookings(data):
-    try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error("Error saving bookings: %s", e)
+def services_keyboard(selected):
+    mask = 0
+    for sid in selected:
+        mask |= SERVICE_BIT.get(sid, 0)
+    return SERVICE_KEYBOARDS[mask]
 
-def booking_id():
-    return int(datetime.now().timestamp() * 1000)
+def masters_keyboard():
+    kb = [[InlineKeyboardButton(f"💈 {m.name}", callback_data=cb("m", m.id))] for m in masters.values()]
+    kb.append([InlineKeyboardButton("🔙 Отмена", callback_data=cb("bs"))])
+    return InlineKeyboardMarkup(kb)
 
-# ---------------- Helpers: dates & times ----------------
-def generate_dates(n=DAYS_AHEAD):
+MASTERS_KEYBOARD = masters_keyboard()
+
+def date_keyboard(master, duration):
+    # Свободные места зависят от длины записи — кэш свой на каждую длительность
+    cache = master.date_caches.get(duration)
+    if cache is None:
+        cache = master.date_caches[duration] = {"day": None, "dates": [], "rows": {}, "frees": None, "markup": None}
     today = date.today()
-    return [today + timedelta(days=i) for i in range(1, n+1)]
+    if cache["day"] != today:
+        # Наступил новый день — строки для прошедших дат больше не нужны
+        dates = [(d.isoformat(), f"{d.strftime('%d.%m.%Y')} ({DAY_NAMES[d.weekday()]})") for d in generate_dates()]
+        cache.update(day=today, dates=dates, rows={}, frees=None, markup=None)
 
-def generate_times():
-    times = []
-    cur = datetime.combine(date.today(), time(hour=WORK_START[0], minute=WORK_START[1]))
-    end_dt = datetime.combine(date.today(), time(hour=WORK_END[0], minute=WORK_END[1]))
-    while cur <= end_dt:
-        times.append(cur.time().strftime("%H:%M"))
-        cur += timedelta(minutes=INTERVAL_MIN)
-    return times
+    frees = tuple(master.store.free_count(iso, duration) for iso, _ in cache["dates"])
+    if frees != cache["frees"]:
+        rows = cache["rows"]
+        kb = []
+        for (iso, label), free in zip(cache["dates"], frees):
+            row = rows.get((iso, free))
+            if row is None:
+                if free:
+                    row = [InlineKeyboardButton(f"📅 {label} — свободно: {free}", callback_data=cb("d", iso))]
+                else:
+                    row = [InlineKeyboardButton(f"🚫 {label} — мест нет", callback_data=cb("df"))]
+                rows[(iso, free)] = row
+            kb.append(row)
+        kb.append(BACK_TO_SERVICES_ROW)
+        cache["frees"] = frees
+        cache["markup"] = InlineKeyboardMarkup(kb)
+    return cache["markup"]
+
+@lru_cache(maxsize=1024)
+def time_keyboard(master_id, mask):
+    # Сетка времени зависит только от мастера и маски стартов, где запись не помещается
+    buttons = []
+    for i, t in enumerate(masters[master_id].slots):
+        if (mask >> i) & 1:
+            buttons.append(InlineKeyboardButton(f"❌ {t}", callback_data=cb("w", t.replace(":", ""))))
+        else:
+            buttons.append(InlineKeyboardButton(t, callback_data=cb("t", t.replace(":", ""))))
+    rows = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton("🔙 Назад", callback_data=cb("bd"))])
+    return InlineKeyboardMarkup(rows)
+
+# ---------------- Notification outbox ----------------
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self):
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+class Outbox:
+    """Фоновая очередь уведомлений админу и клиентам.
+
+    Обработчики только ставят сообщение в очередь и сразу отвечают
+    пользователю. Отправитель соблюдает лимиты Telegram (общий и на чат),
+    повторяет с экспоненциальной задержкой и при всплеске склеивает
+    накопившиеся уведомления админу в одну сводку. Очередь пишется в
+    append-only лог, поэтому переживает перезапуск.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = deque()
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self._log = None
+        self._log_lines = 0
+        self._next_id = 1
+        self._wakeup = None
+        self._task = None
+
+    def load(self):
+        items = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if event.get("op") == "add":
+                        items[event["item"]["id"]] = event["item"]
+                    elif event.get("op") == "done":
+                        items.pop(event.get("id"), None)
+        self.pending = deque(items.values())
+        self._next_id = max(items, default=0) + 1
+        self._rewrite_log()
+        if self.pending:
+            logger.info("В очереди уведомлений после перезапуска: %d", len(self.pending))
+
+    def _rewrite_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        # Новый лог пишется рядом и подменяет старый целиком: упав посреди перезаписи,
+        # не потеряем очередь. Не вышло — продолжаем дописывать в старый
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                for item in self.pending:
+                    f.write(json.dumps({"op": "add", "item": item}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            fsync_dir(self.path)
+        except Exception as e:
+            logger.error("Error saving outbox: %s", e)
+            return
+        self._log_lines = len(self.pending)
+
+    def _write(self, event):
+        try:
+            if self._log is None:
+                self._log = open(self.path, "a", encoding="utf-8")
+            self._log.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._log.flush()
+        except Exception as e:
+            logger.error("Error saving outbox: %s", e)
+        self._log_lines += 1
+
+    def enqueue(self, chat_id, text, parse_mode=None):
+        item = {
+            "id": self._next_id,
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode,
+            "attempts": 0,
+            "not_before": 0,
+        }
+        self._next_id += 1
+        self.pending.append(item)
+        self._write({"op": "add", "item": item})
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _done(self, items):
+        for item in items:
+            self.pending.remove(item)
+            self._write({"op": "done", "id": item["id"]})
+        # Лог растёт только пока есть что отправлять — при пустой очереди начинаем с нуля
+        if not self.pending or self._log_lines > 1000:
+            self._rewrite_log()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                # Полные ведра ничего не ограничивают — их можно забыть
+                self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if b.wait_time() > 0}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, 1)
+        return bucket
+
+    def _next_ready(self):
+        now = monotonic()
+        best_delay = None
+        for item in self.pending:
+            delay = max(item["not_before"] - now, self._chat_bucket(item["chat_id"]).wait_time())
+            if delay <= 0:
+                return item, 0
+            if best_delay is None or delay < best_delay:
+                best_delay = delay
+        return None, best_delay
+
+    def _take_batch(self, item):
+        if item["chat_id"] != ADMIN_ID:
+            return [item]
+        # Всё, что успело накопиться для админа, уходит одной сводкой
+        now = monotonic()
+        batch, size = [], 0
+        for other in self.pending:
+            if other["chat_id"] != ADMIN_ID or other["parse_mode"] != item["parse_mode"] or other["not_before"] > now:
+                continue
+            size += len(other["text"]) + 10
+            if batch and size > OUTBOX_DIGEST_LIMIT:
+                break
+            batch.append(other)
+        return batch
+
+    async def _send(self, bot, batch):
+        head = batch[0]
+        if len(batch) == 1:
+            text = head["text"]
+        else:
+            text = f"📬 Уведомлений: {len(batch)}\n\n" + "\n\n➖➖➖\n\n".join(i["text"] for i in batch)
+        self.global_bucket.consume()
+        self._chat_bucket(head["chat_id"]).consume()
+        try:
+            await bot.send_message(chat_id=head["chat_id"], text=text, parse_mode=head["parse_mode"])
+        except RetryAfter as e:
+            # Telegram сам сказал, сколько ждать, — попытку не засчитываем
+            for item in self.pending:
+                if item["chat_id"] == head["chat_id"]:
+                    item["not_before"] = monotonic() + e.retry_after
+            return
+        except (Forbidden, BadRequest) as e:
+            logger.error("Notify error (chat %s), dropped: %s", head["chat_id"], e)
+            self._done(batch)
+            return
+        except TelegramError as e:
+            for item in batch:
+                item["attempts"] += 1
+                item["not_before"] = monotonic() + min(2 ** item["attempts"], 300)
+            dropped = [i for i in batch if i["attempts"] >= OUTBOX_MAX_ATTEMPTS]
+            logger.warning("Notify error (chat %s), attempt %d: %s", head["chat_id"], head["attempts"], e)
+            if dropped:
+                logger.error("Notify dropped after %d attempts (chat %s)", OUTBOX_MAX_ATTEMPTS, head["chat_id"])
+                self._done(dropped)
+            return
+        self._done(batch)
+
+    async def run(self, bot):
+        self._wakeup = asyncio.Event()
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            item, delay = self._next_ready()
+            if item is None:
+                # Ждём ближайшего готового сообщения или нового в очереди
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            delay = self.global_bucket.wait_time()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            await self._send(bot, self._take_batch(item))
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._log is not None:
+            self._log.close()
+            self._log = None
 
-def slot_is_free(bookings, date_iso, time_str):
-    for b in bookings:
-        if b.get("date") == date_iso and b.get("time") == time_str and b.get("status") == "confirmed":
+outbox = Outbox(process_file(OUTBOX_FILE))
+
+def notify(chat_id, text, parse_mode=None):
+    outbox.enqueue(chat_id, text, parse_mode)
+
+# ---------------- Edit coalescing ----------------
+class EditCoalescer:
+    """Склейка частых правок одного сообщения.
+
+    Правка уходит не сразу: за окно window копится последнее состояние
+    сообщения, и в Telegram отправляется одна правка с ним. Если это
+    состояние уже показано, вызова нет вовсе. Другой обработчик, правящий
+    то же сообщение, отменяет отложенную правку через discard().
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}   # (chat_id, message_id) -> (query, text, reply_markup)
+        self.tasks = {}     # (chat_id, message_id) -> задача отложенной правки
+
+    @staticmethod
+    def _key(query):
+        return query.message.chat_id, query.message.message_id
+
+    def schedule(self, query, text, reply_markup=None):
+        key = self._key(query)
+        if key in self.pending:
+            metrics.inc("bot_edits_skipped_total", reason="coalesced")
+        self.pending[key] = (query, text, reply_markup)
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self._flush(key))
+
+    def discard(self, query):
+        if query.message is None:
+            return
+        key = self._key(query)
+        task = self.tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+            if self.pending.pop(key, None) is not None:
+                metrics.inc("bot_edits_skipped_total", reason="discarded")
+
+    async def _flush(self, key):
+        shown = None
+        try:
+            while key in self.pending:
+                await asyncio.sleep(self.window)
+                query, text, markup = self.pending.pop(key, (None, None, None))
+                if query is None:
+                    return
+                # Что сейчас на экране: наша прошлая правка или сообщение из последнего нажатия
+                if shown is None:
+                    shown = (query.message.text, query.message.reply_markup)
+                if shown == (text, markup):
+                    metrics.inc("bot_edits_skipped_total", reason="unchanged")
+                    continue
+                try:
+                    await query.edit_message_text(text, reply_markup=markup)
+                    shown = (text, markup)
+                except RetryAfter as e:
+                    # Повторим после паузы — с самым свежим состоянием, если оно успело смениться
+                    self.pending.setdefault(key, (query, text, markup))
+                    await asyncio.sleep(e.retry_after)
+                except BadRequest as e:
+                    if "not modified" in str(e).lower():
+                        metrics.inc("bot_edits_skipped_total", reason="not_modified")
+                        shown = (text, markup)
+                    else:
+                        logger.warning("Edit error (chat %s): %s", key[0], e)
+        except Exception as e:
+            logger.error("Edit coalescer failed (chat %s): %s", key[0], e)
+        finally:
+            if self.tasks.get(key) is asyncio.current_task():
+                del self.tasks[key]
+
+    async def stop(self):
+        # Отложенные правки — только вид клавиатуры; выбор уже сохранён в user_data
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        self.pending.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+edits = EditCoalescer(EDIT_COALESCE_SEC)
+
+# ---------------- Reminders ----------------
+class IndexedHeap:
+    """Двоичная min-куча (due, key) с индексом key -> позиция.
+
+    В отличие от голого heapq, элемент удаляется по ключу за O(log n):
+    его место занимает последний элемент и просеивается.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.pos = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.pos
+
+    def heapify(self, entries):
+        self.items = list(entries)
+        heapq.heapify(self.items)
+        self.pos = {key: i for i, (_, key) in enumerate(self.items)}
+
+    def peek(self):
+        return self.items[0] if self.items else None
+
+    def push(self, due, key):
+        self.remove(key)
+        self.items.append((due, key))
+        self.pos[key] = len(self.items) - 1
+        self._up(len(self.items) - 1)
+
+    def pop(self):
+        top = self.items[0]
+        self.remove(top[1])
+        return top
+
+    def remove(self, key):
+        i = self.pos.pop(key, None)
+        if i is None:
             return False
-    return True
+        last = self.items.pop()
+        if i < len(self.items):
+            self.items[i] = last
+            self.pos[last[1]] = i
+            self._up(self._down(i))
+        return True
+
+    def _swap(self, i, j):
+        items = self.items
+        items[i], items[j] = items[j], items[i]
+        self.pos[items[i][1]] = i
+        self.pos[items[j][1]] = j
+
+    def _up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self.items[i] >= self.items[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
+        return i
+
+    def _down(self, i):
+        n = len(self.items)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and self.items[child] < self.items[smallest]:
+                    smallest = child
+            if smallest == i:
+                return i
+            self._swap(i, smallest)
+            i = smallest
+
+class ReminderScheduler:
+    """Напоминания клиентам за REMINDER_HOURS до визита.
+
+    Все напоминания — одна куча по времени отправки с ключом
+    (мастер, id записи, часы). Подтверждение записи добавляет её
+    напоминания, отмена удаляет их за O(log n); задача спит ровно
+    до ближайшего. Сами сообщения уходят через очередь уведомлений.
+
+    Отправленные напоминания нигде не отмечаются: при старте куча
+    строится только из будущих, поэтому после перезапуска ничего не
+    дублируется, а пропущенные за время простоя не досылаются.
+    """
+
+    def __init__(self, hours):
+        self.hours = hours
+        self.heap = IndexedHeap()
+        self.bookings = {}  # (мастер, id) -> запись
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def _entries(self, master_id, b, now):
+        try:
+            at = datetime.fromisoformat(f"{b['date']}T{b['time']}").timestamp()
+        except (KeyError, ValueError):
+            return []
+        return [(at - h * 3600, (master_id, b.get("id"), h)) for h in self.hours if at - h * 3600 > now]
+
+    def rebuild(self):
+        now = datetime.now().timestamp()
+        entries = []
+        self.bookings = {}
+        for m in masters.values():
+            for b in m.store.active.values():
+                mine = self._entries(m.id, b, now)
+                if mine:
+                    entries.extend(mine)
+                    self.bookings[(m.id, b.get("id"))] = b
+        # Одна heapify за O(n) вместо n вставок
+        self.heap.heapify(entries)
+        self._wake.set()
+        logger.info("Напоминаний запланировано: %d", len(self.heap))
+
+    def schedule(self, master_id, b):
+        top = self.heap.peek()
+        for due, key in self._entries(master_id, b, datetime.now().timestamp()):
+            self.heap.push(due, key)
+            self.bookings[key[:2]] = b
+        if self.heap.peek() is not top:
+            self._wake.set()
+
+    def unschedule(self, master_id, b):
+        for h in self.hours:
+            self.heap.remove((master_id, b.get("id"), h))
+        self.bookings.pop((master_id, b.get("id")), None)
+
+    def on_booking(self, master_id, event, b):
+        if event == "confirmed":
+            self.schedule(master_id, b)
+        elif event == "cancelled":
+            self.unschedule(master_id, b)
+
+    def _send(self, key):
+        master_id, bid, h = key
+        b = self.bookings.get((master_id, bid))
+        if not any((master_id, bid, other) in self.heap for other in self.hours):
+            self.bookings.pop((master_id, bid), None)
+        if b is None or b.get("status") != "confirmed":
+            return
+        master = masters.get(master_id)
+        notify(
+            int(b["user_id"]),
+            f"⏰ Напоминание: через {h} ч. у вас запись"
+            f"{f' к мастеру {master.name}' if master else ''}\n\n"
+            f"📅 {datetime.fromisoformat(b['date']).strftime('%d.%m.%Y')} в {b['time']}\n"
+            f"💈 {', '.join(b.get('services', []))}\n\n"
+            f"Ждём вас! Если планы изменились — отмените запись кнопкой в сообщении о записи."
+        )
+
+    async def run(self):
+        while True:
+            top = self.heap.peek()
+            now = datetime.now().timestamp()
+            if top is not None and top[0] <= now:
+                self._send(self.heap.pop()[1])
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), None if top is None else top[0] - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+reminders = ReminderScheduler(REMINDER_HOURS)
+
+# ---------------- Flow state persistence ----------------
+FLOW_KEYS = ("master", "selected_services", "date", "time", "name", "phone")
+
+class FlowStateStore:
+    """Состояние незаконченных записей (мастер, услуги, дата, время, имя, телефон).
+
+    Лежит в SQLite по строке на пользователя. По таймеру пишутся только
+    изменившиеся пользователи, одной транзакцией; читается состояние
+    лениво — при первом апдейте пользователя после перезапуска.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.saved = {}   # user_id -> последний записанный снимок (None — пусто)
+        self.dirty = {}   # user_id -> снимок к записи (None — удалить)
+        self._reader = None
+        self._writer = None
+        self._task = None
+
+    def _connect(self, check_same_thread=True):
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=check_same_thread)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS flows ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        return db
+
+    def open(self):
+        self._reader = self._connect()
+        # Брошенные давно записи не восстанавливаем
+        self._reader.execute("DELETE FROM flows WHERE updated < ?", (datetime.now().timestamp() - FLOW_STATE_TTL,))
+
+    def restore(self, user_id, user_data):
+        if user_id in self.saved:
+            return
+        if self._reader is None:
+            self._reader = self._connect()
+        row = self._reader.execute("SELECT data FROM flows WHERE user_id = ?", (user_id,)).fetchone()
+        snapshot = json.loads(row[0]) if row else None
+        self.saved[user_id] = snapshot
+        if snapshot and not user_data:
+            user_data.update(snapshot)
+
+    def track(self, user_id, user_data):
+        # Копируем списки: handle_service меняет selected_services на месте
+        snapshot = {k: list(v) if isinstance(v, list) else v for k, v in user_data.items() if k in FLOW_KEYS}
+        snapshot = snapshot or None
+        if snapshot != self.saved.get(user_id):
+            self.saved[user_id] = snapshot
+            self.dirty[user_id] = snapshot
+
+    def _write(self, batch):
+        if self._writer is None:
+            self._writer = self._connect(check_same_thread=False)
+        now = datetime.now().timestamp()
+        db = self._writer
+        db.execute("BEGIN")
+        try:
+            db.executemany(
+                "INSERT OR REPLACE INTO flows (user_id, data, updated) VALUES (?, ?, ?)",
+                [(uid, json.dumps(snap, ensure_ascii=False), now) for uid, snap in batch.items() if snap],
+            )
+            db.executemany("DELETE FROM flows WHERE user_id = ?", [(uid,) for uid, snap in batch.items() if not snap])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            logger.error("Error saving flow state: %s", e)
+            # Вернём в очередь то, что не успело измениться снова
+            for uid, snap in batch.items():
+                self.dirty.setdefault(uid, snap)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FLOW_FLUSH_SEC)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        for db in (self._reader, self._writer):
+            if db is not None:
+                db.close()
+        self._reader = self._writer = None
+
+flow_state = FlowStateStore(process_file(FLOW_STATE_FILE))
+
+@timed
+async def restore_flow_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user is not None:
+        flow_state.restore(update.effective_user.id, context.user_data)
+
+@timed
+async def track_flow_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user is not None:
+        flow_state.track(update.effective_user.id, context.user_data)
 
 # ---------------- Handlers ----------------
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
+    release_holds(update.effective_user.id)
     
     kb = [
-        [InlineKeyboardButton("📅 Записаться", callback_data="book")],
+        [InlineKeyboardButton("📅 Записаться", callback_data=cb("b"))],
+        [InlineKeyboardButton("📋 Мои записи", callback_data=cb("my"))],
     ]
     
+    names = ", ".join(m.name for m in masters.values())
+    whom = f"к мастеру {names}" if len(masters) == 1 else f"к мастерам: {names}"
+    
     if update.message:
         await update.message.reply_text(
-            f"Привет! Я бот для записи к мастеру {MASTER_NAME}. ✨\n\n"
+            f"Привет! Я бот для записи {whom}. ✨\n\n"
             f"Нажмите кнопку ниже чтобы записаться:",
             reply_markup=InlineKeyboardMarkup(kb)
         )
     else:
         await update.callback_query.edit_message_text(
-            f"Привет! Я бот для записи к мастеру {MASTER_NAME}. ✨\n\n"
+            f"Привет! Я бот для записи {whom}. ✨\n\n"
             f"Нажмите кнопку ниже чтобы записаться:",
             reply_markup=InlineKeyboardMarkup(kb)
         )
 
+@timed
 async def handle_book(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     context.user_data["selected_services"] = []
+    flow_step("book")
+    
+    if len(masters) > 1:
+        await query.edit_message_text(
+            "📝 *Начата новая запись*\n\n"
+            "Выберите мастера:",
+            reply_markup=MASTERS_KEYBOARD,
+            parse_mode='Markdown'
+        )
+        return
     
+    context.user_data["master"] = default_master().id
     await query.edit_message_text(
         "📝 *Начата новая запись*\n\n"
         "Выберите услуги (нажмите для отметки):",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("💇 Мужская стрижка — 80,000 сум", callback_data="svc_1")],
-            [InlineKeyboardButton("🧔 Борода — 50,000 сум", callback_data="svc_2")],
-            [InlineKeyboardButton("✂️ Стрижка + укладка — 100,000 сум", callback_data="svc_3")],
-            [InlineKeyboardButton("🎨 Окрашивание волос — 150,000 сум", callback_data="svc_4")],
-            [InlineKeyboardButton("✅ Готово", callback_data="svc_done")],
-            [InlineKeyboardButton("🔙 Отмена", callback_data="back_start")],
-        ]),
+        reply_markup=SERVICE_KEYBOARDS[0],
         parse_mode='Markdown'
     )
 
-async def handle_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def handle_master(update: Update, context: ContextTypes.DEFAULT_TYPE, master):
+    query = update.callback_query
+    await query.answer()
+    
+    # Смена мастера сбрасывает выбранные дату, время и закреплённый слот
+    release_holds(query.from_user.id)
+    context.user_data.pop("date", None)
+    context.user_data.pop("time", None)
+    context.user_data["master"] = master.id
+    sel = context.user_data.setdefault("selected_services", [])
+    flow_step("master")
+    
+    await query.edit_message_text(
+        f"💈 Мастер: {master.name}\n\n"
+        f"Выберите услуги (нажмите для отметки):",
+        reply_markup=services_keyboard(sel)
+    )
+
+@timed
+async def handle_service(update: Update, context: ContextTypes.DEFAULT_TYPE, sid):
     query = update.callback_query
     await query.answer()
-    data = query.data
 
-    if data == "svc_done":
-        if not context.user_data.get("selected_services"):
-            await query.answer("Выберите хотя бы одну услугу", show_alert=True)
-            return
-        
-        dates = generate_dates()
-        kb = []
-        for d in dates:
-            day_names = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-            day_name = day_names[d.weekday()]
-            kb.append([InlineKeyboardButton(f"📅 {d.strftime('%d.%m.%Y')} ({day_name})", callback_data=f"date_{d.isoformat()}")])
-        kb.append([InlineKeyboardButton("🔙 Назад", callback_data="back_services")])
-        
-        await query.edit_message_text(
-            "Выберите дату:",
-            reply_markup=InlineKeyboardMarkup(kb)
-        )
+    sel = context.user_data.get("selected_services", [])
+    if sid in sel:
+        sel.remove(sid)
     else:
-        sid = int(data.split("_")[1])
-        sel = context.user_data.get("selected_services", [])
-        if sid in sel:
-            sel.remove(sid)
-        else:
-            sel.append(sid)
-        context.user_data["selected_services"] = sel
-        
-        # Обновляем кнопки с отметками
-        kb = []
-        for s in SERVICES:
-            prefix = "✅ " if s["id"] in sel else ""
-            kb.append([InlineKeyboardButton(f"{prefix}{s['name']} — {s['price']}", callback_data=f"svc_{s['id']}")])
-        kb.append([InlineKeyboardButton("✅ Готово", callback_data="svc_done")])
-        kb.append([InlineKeyboardButton("🔙 Отмена", callback_data="back_start")])
-        
-        await query.edit_message_text(
-            "Выберите услуги (нажмите для отметки):",
-            reply_markup=InlineKeyboardMarkup(kb)
-        )
+        sel.append(sid)
+    context.user_data["selected_services"] = sel
+    
+    # Обновляем кнопки с отметками; серия быстрых нажатий — одна правка
+    edits.schedule(query, "Выберите услуги (нажмите для отметки):", services_keyboard(sel))
 
-async def handle_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def handle_services_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    if not context.user_data.get("selected_services"):
+        await query.answer("Выберите хотя бы одну услугу", show_alert=True)
+        return
     await query.answer()
-    data = query.data
+    
+    flow_step("services")
+    await query.edit_message_text(
+        "Выберите дату:",
+        reply_markup=date_keyboard(flow_master(context), flow_duration(context))
+    )
 
-    if data == "back_services":
-        sel = context.user_data.get("selected_services", [])
-        kb = []
-        for s in SERVICES:
-            prefix = "✅ " if s["id"] in sel else ""
-            kb.append([InlineKeyboardButton(f"{prefix}{s['name']} — {s['price']}", callback_data=f"svc_{s['id']}")])
-        kb.append([InlineKeyboardButton("✅ Готово", callback_data="svc_done")])
-        kb.append([InlineKeyboardButton("🔙 Отмена", callback_data="back_start")])
-        
-        await query.edit_message_text(
-            "Выберите услуги (нажмите для отметки):",
-            reply_markup=InlineKeyboardMarkup(kb)
-        )
-    else:
-        iso_date = data.replace("date_", "")
-        context.user_data["date"] = iso_date
-        
-        sel_date = context.user_data.get("date")
-        bookings = load_bookings()
-        all_times = generate_times()
-        
-        buttons = []
-        for t in all_times:
-            if slot_is_free(bookings, sel_date, t):
-                buttons.append(InlineKeyboardButton(t, callback_data=f"time_{t}"))
-            else:
-                buttons.append(InlineKeyboardButton(f"❌ {t}", callback_data="busy"))
-        
-        rows = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
-        rows.append([InlineKeyboardButton("🔙 Назад", callback_data="back_dates")])
-        
-        date_display = datetime.fromisoformat(sel_date).strftime('%d.%m.%Y')
-        await query.edit_message_text(
-            f"🕐 Выберите время на {date_display}:",
-            reply_markup=InlineKeyboardMarkup(rows)
-        )
+@timed
+async def handle_date(update: Update, context: ContextTypes.DEFAULT_TYPE, iso_date):
+    query = update.callback_query
+    await query.answer()
+
+    context.user_data["date"] = iso_date
+    flow_step("date")
+    
+    master = flow_master(context)
+    duration = flow_duration(context)
+    mask = (master.store.busy_mask(iso_date, duration)
+            | master.holds.mask(iso_date, query.from_user.id, master.store.starts, duration))
+    
+    date_display = datetime.fromisoformat(iso_date).strftime('%d.%m.%Y')
+    await query.edit_message_text(
+        f"🕐 Выберите время на {date_display}:",
+        reply_markup=time_keyboard(master.id, mask)
+    )
 
-async def handle_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def handle_date_full(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer("На этот день свободных мест нет", show_alert=True)
+
+@timed
+async def handle_time(update: Update, context: ContextTypes.DEFAULT_TYPE, time_str):
+    # Отвечаем на нажатие один раз — второй answerCallbackQuery Telegram отклонит
     query = update.callback_query
+
+    # Закрепляем всё время записи, пока клиент вводит имя и телефон
+    master = flow_master(context)
+    dt = context.user_data.get("date")
+    if dt is None or time_str not in master.store.slot_index:
+        await query.answer("Сессия записи устарела. /start чтобы начать заново.", show_alert=True)
+        return
+    start, duration = to_minutes(time_str), flow_duration(context)
+    if (not master.store.fits(dt, start, duration)
+            or not master.holds.hold(dt, start, start + duration, query.from_user.id)):
+        await query.answer("Слот уже заняли", show_alert=True)
+        return
     await query.answer()
-    data = query.data
+    
+    context.user_data["time"] = time_str
+    flow_step("time")
+    await query.edit_message_text(
+        f"⏳ Время {time_span(time_str, duration)} закреплено за вами на {HOLD_TTL_SEC // 60} минут.\n\n"
+        f"👤 Введите ваше имя:"
+    )
 
-    if data == "back_dates":
-        dates = generate_dates()
-        kb = []
-        for d in dates:
-            day_names = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-            day_name = day_names[d.weekday()]
-            kb.append([InlineKeyboardButton(f"📅 {d.strftime('%d.%m.%Y')} ({day_name})", callback_data=f"date_{d.isoformat()}")])
-        kb.append([InlineKeyboardButton("🔙 Назад", callback_data="back_services")])
-        
-        await query.edit_message_text(
-            "Выберите дату:",
-            reply_markup=InlineKeyboardMarkup(kb)
-        )
-    elif data == "busy":
-        await query.answer("Этот слот занят", show_alert=True)
+@timed
+async def handle_busy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer("Это время занято — выбранные услуги сюда не помещаются", show_alert=True)
+
+@timed
+async def handle_waitlist(update: Update, context: ContextTypes.DEFAULT_TYPE, time_str):
+    # Нажатие на занятое время — подписка на его освобождение, повторное нажатие — отписка
+    query = update.callback_query
+    master = flow_master(context)
+    dt = context.user_data.get("date")
+    if dt is None or time_str not in master.store.slot_index:
+        await query.answer("Сессия записи устарела. /start чтобы начать заново.", show_alert=True)
+        return
+    start, duration = to_minutes(time_str), flow_duration(context)
+    if start + duration > master.store.day_end:
+        # До конца дня не поместится, сколько ни жди
+        await query.answer("Это время занято — выбранные услуги сюда не помещаются", show_alert=True)
+        return
+    if (master.store.fits(dt, start, duration)
+            and not master.holds.held_by_other(dt, start, start + duration, query.from_user.id)):
+        await query.answer("Это время уже освободилось — откройте дату заново", show_alert=True)
+        return
+    subscribed = master.waitlist.toggle(dt, time_str, query.from_user.id, duration)
+    if subscribed is None:
+        text = f"Можно ждать не больше {WAITLIST_MAX} занятых слотов. Нажмите на один из них ещё раз, чтобы отписаться."
+    elif subscribed:
+        text = f"🔔 Время {time_str} занято. Сообщим, если оно освободится. Нажмите ещё раз, чтобы отписаться."
     else:
-        time_str = data.replace("time_", "")
-        
-        bookings = load_bookings()
-        if not slot_is_free(bookings, context.user_data["date"], time_str):
-            await query.answer("Слот уже заняли", show_alert=True)
-            return
-        
-        context.user_data["time"] = time_str
-        await query.edit_message_text("👤 Введите ваше имя:")
+        text = f"Вы больше не ждёте время {time_str}."
+    await query.answer(text, show_alert=True)
 
+@timed
 async def name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = update.message.text.strip()
     if len(name) < 2:
@@ -265,6 +3077,7 @@ async def name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     context.user_data["name"] = name
+    flow_step("name")
     
     contact_keyboard = [[KeyboardButton("📱 Отправить номер", request_contact=True)]]
     await update.message.reply_text(
@@ -272,6 +3085,7 @@ async def name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=ReplyKeyboardMarkup(contact_keyboard, one_time_keyboard=True, resize_keyboard=True)
     )
 
+@timed
 async def phone_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.contact:
         phone = update.message.contact.phone_number
@@ -283,9 +3097,15 @@ async def phone_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Неверный номер. Попробуйте еще раз:")
         return
     
+    if "date" not in context.user_data or "time" not in context.user_data:
+        await update.message.reply_text("Сессия записи устарела. Нажмите /start чтобы начать заново.")
+        return
+    
     context.user_data["phone"] = phone
+    flow_step("phone")
     
-    services = [s["name"] for s in SERVICES if s["id"] in context.user_data.get("selected_services", [])]
+    selected = [s for s in SERVICES if s["id"] in context.user_data.get("selected_services", [])]
+    services = [s["name"] for s in selected]
     dt = context.user_data["date"]
     tm = context.user_data["time"]
     
@@ -295,255 +3115,426 @@ async def phone_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"- Имя: {context.user_data['name']}\n"
         f"  Телефон: {phone}\n"
         f"- Услуги: {', '.join(services)}\n"
+        f"  Стоимость: {format_price(sum(s['price'] for s in selected))}\n"
         f"  Дата: {datetime.fromisoformat(dt).strftime('%d.%m.%Y')}\n"
-        f"  Время: {tm}\n"
-        f"  Мастер: {MASTER_NAME}\n\n"
+        f"  Время: {time_span(tm, flow_duration(context))}\n"
+        f"  Мастер: {flow_master(context).name}\n\n"
+        f"---\n"
+    )
+    
+    kb = [
+        [InlineKeyboardButton("✅ Подтвердить", callback_data=cb("cb"))],
+        [InlineKeyboardButton("❌ Отмена", callback_data=cb("cf"))]
+    ]
+    
+    await update.message.reply_text(summary, reply_markup=InlineKeyboardMarkup(kb))
+
+@timed
+async def handle_cancel_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    await query.edit_message_text("Запись отменена. /start чтобы начать заново.")
+    flow_step("abandoned")
+    context.user_data.clear()
+    release_holds(query.from_user.id)
+
+@timed
+async def handle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # На нажатие отвечаем один раз: пустым ответом или окном с ошибкой — второй ответ Telegram отклонит
+    query = update.callback_query
+
+    if not all(k in context.user_data for k in ("date", "time", "name", "phone")):
+        await query.answer()
+        await query.edit_message_text("Сессия записи устарела. /start чтобы начать заново.")
+        return
+    
+    master = flow_master(context)
+    dt = context.user_data["date"]
+    tm = context.user_data["time"]
+    duration = flow_duration(context)
+    start = to_minutes(tm)
+    
+    b_id = master.booking_id()
+    selected = [s for s in SERVICES if s["id"] in context.user_data.get("selected_services", [])]
+    services = [s["name"] for s in selected]
+    
+    booking = {
+        "id": b_id,
+        "master": master.id,
+        "user_id": str(query.from_user.id),
+        "name": context.user_data["name"],
+        "phone": context.user_data["phone"],
+        "services": services,
+        "service_ids": [s["id"] for s in selected],
+        "price": sum(s["price"] for s in selected),
+        "date": dt,
+        "time": tm,
+        "duration": duration,
+        "status": "confirmed",
+        "created": datetime.now().isoformat()
+    }
+    
+    # Своё закрепление могло истечь — тогда время мог успеть закрепить другой клиент.
+    # Проверка удержаний и пересечений и запись в память идут до первого await в add(),
+    # дальше ждём только подтверждения записи на диск (в SQLite проверка повторяется в транзакции)
+    try:
+        booked = (not master.holds.held_by_other(dt, start, start + duration, query.from_user.id)
+                  and await master.store.add(booking))
+    except STORAGE_ERRORS:
+        await query.answer("Не удалось сохранить запись, попробуйте ещё раз", show_alert=True)
+        return
+    if not booked:
+        flow_step("slot_taken")
+        await query.answer("Слот уже заняли", show_alert=True)
+        return
+    await query.answer()
+    master.holds.release(query.from_user.id)
+    flow_step("confirmed")
+    
+    notify(
+        ADMIN_ID,
+        f"🆕 Новая запись #{b_id}\n"
+        f"💈 Мастер: {master.name}\n"
+        f"👤 {booking['name']}\n"
+        f"📞 {booking['phone']}\n"
+        f"💈 {', '.join(services)}\n"
+        f"📅 {dt} {time_span(tm, duration)}\n\n"
+        f"❌ Удалить запись: /delete_{b_id}"
+    )
+    
+    # ФИНАЛЬНОЕ СООБЩЕНИЕ
+    date_display = datetime.fromisoformat(dt).strftime('%d.%m.%Y')
+    
+    final_text = (
+        f"### Вы записаны к {master.name}!\n\n"
+        f"- Услуги: {', '.join(services)}\n"
+        f"  Дата: {date_display}\n"
+        f"  Время: {time_span(tm, duration)}\n"
+        f"  Имя: {context.user_data['name']}\n"
+        f"  Телефон: {context.user_data['phone']}\n\n"
+        f"---\n\n"
+        f"### Ждем вас!\n\n"
+        f"Если передумаете, можете отменить запись:\n"
+        f"01:00\n\n"
         f"---\n"
     )
     
-    kb = [
-        [InlineKeyboardButton("✅ Подтвердить", callback_data="confirm_book")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="cancel_flow")]
-    ]
+    kb = [
+        [InlineKeyboardButton("❌ Отменить эту запись", callback_data=cb("c", b_id))],
+    ]
+    
+    await query.message.reply_text(
+        final_text,
+        reply_markup=InlineKeyboardMarkup(kb),
+        parse_mode='Markdown'
+    )
+    
+    context.user_data.clear()
+
+async def cancel_own_booking(query, bid):
+    # Отмена клиентом своей записи; на нажатие отвечает сама. None — не вышло (клиенту уже сказали)
+    logger.info(f"Клиент отменяет запись #{bid}")
+    
+    master, b = find_booking(bid)
+    if b is None:
+        await query.answer("❌ Запись не найдена", show_alert=True)
+        return None
+    
+    if str(b.get("user_id")) != str(query.from_user.id):
+        await query.answer("❌ Это не ваша запись", show_alert=True)
+        return None
+    
+    try:
+        # ОТМЕНЯЕМ ЗАПИСЬ
+        await master.store.cancel(b, "client")
+    except STORAGE_ERRORS:
+        await query.answer("Не удалось отменить запись, попробуйте ещё раз", show_alert=True)
+        return None
+    await query.answer()
+    
+    # Уведомление админу
+    notify(
+        ADMIN_ID,
+        f"❌ КЛИЕНТ ОТМЕНИЛ ЗАПИСЬ #{bid}\n"
+        f"👤 {b.get('name')} ({b.get('phone')})\n"
+        f"📅 {b.get('date')} {b.get('time')}\n"
+        f"💈 {', '.join(b.get('services', []))}"
+    )
+    return b
+
+@timed
+async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, bid):
+    query = update.callback_query
+    b = await cancel_own_booking(query, bid)
+    if b is None:
+        return
+    
+    # Сообщение об отмене
+    date_display = datetime.fromisoformat(b.get('date')).strftime('%d.%m.%Y')
     
-    await update.message.reply_text(summary, reply_markup=InlineKeyboardMarkup(kb))
+    await query.edit_message_text(
+        f"✅ *Запись отменена!*\n\n"
+        f"📅 {date_display} {b.get('time')}\n"
+        f"💈 {', '.join(b.get('services', []))}\n\n"
+        f"Для новой записи нажмите /start",
+        parse_mode='Markdown'
+    )
 
-async def handle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# ---------------- My bookings ----------------
+def my_bookings_view(user_id, notice=""):
+    # Предстоящие записи клиента у всех мастеров этого процесса: срез индекса по клиенту
+    now = datetime.now()
+    today, now_time = now.date().isoformat(), now.strftime("%H:%M")
+    found = sorted(
+        ((b, m) for m in masters.values() for b in m.store.upcoming(user_id, today, now_time, MY_BOOKINGS_MAX)),
+        key=lambda item: (item[0].get("date"), item[0].get("time")),
+    )[:MY_BOOKINGS_MAX]
+    kb = []
+    if not found:
+        text = notice + "У вас нет предстоящих записей."
+    else:
+        lines = [notice + "📋 Ваши записи:"]
+        for b, m in found:
+            day = datetime.fromisoformat(b.get("date")).strftime("%d.%m.%Y")
+            start, end = m.store.span(b)
+            lines.append(f"📅 {day} {time_span(b.get('time'), end - start)} — {m.name}\n💈 {', '.join(b.get('services', []))}")
+            kb.append([InlineKeyboardButton(f"❌ Отменить {day[:5]} {b.get('time')}", callback_data=cb("mc", b.get("id")))])
+        text = "\n\n".join(lines)
+    kb.append([InlineKeyboardButton("📅 Записаться", callback_data=cb("b"))])
+    return text, InlineKeyboardMarkup(kb)
+
+@timed
+async def my_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text, markup = my_bookings_view(update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=markup)
+
+@timed
+async def handle_my(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
+    text, markup = my_bookings_view(query.from_user.id)
+    await query.edit_message_text(text, reply_markup=markup)
 
-    if data == "cancel_flow":
-        await query.edit_message_text("Запись отменена. /start чтобы начать заново.")
-        context.user_data.clear()
+@timed
+async def handle_my_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, bid):
+    query = update.callback_query
+    b = await cancel_own_booking(query, bid)
+    if b is None:
         return
-    
-    if data == "confirm_book":
-        bookings = load_bookings()
-        dt = context.user_data["date"]
-        tm = context.user_data["time"]
-        
-        if not slot_is_free(bookings, dt, tm):
-            await query.answer("Слот уже заняли", show_alert=True)
-            return
-        
-        b_id = booking_id()
-        services = [s["name"] for s in SERVICES if s["id"] in context.user_data.get("selected_services", [])]
-        
-        booking = {
-            "id": b_id,
-            "user_id": str(query.from_user.id),
-            "name": context.user_data["name"],
-            "phone": context.user_data["phone"],
-            "services": services,
-            "date": dt,
-            "time": tm,
-            "status": "confirmed",
-            "created": datetime.now().isoformat()
-        }
-        
-        bookings.append(booking)
-        save_bookings(bookings)
-        
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=(
-                    f"🆕 Новая запись #{b_id}\n"
-                    f"👤 {booking['name']}\n"
-                    f"📞 {booking['phone']}\n"
-                    f"💈 {', '.join(services)}\n"
-                    f"📅 {dt} {tm}\n\n"
-                    f"❌ Удалить запись: /delete_{b_id}"
-                )
-            )
-        except Exception as e:
-            logger.error("Admin notify error: %s", e)
-        
-        # ФИНАЛЬНОЕ СООБЩЕНИЕ
-        date_display = datetime.fromisoformat(dt).strftime('%d.%m.%Y')
-        
-        final_text = (
-            f"### Вы записаны к {MASTER_NAME}!\n\n"
-            f"- Услуги: {', '.join(services)}\n"
-            f"  Дата: {date_display}\n"
-            f"  Время: {tm}\n"
-            f"  Имя: {context.user_data['name']}\n"
-            f"  Телефон: {context.user_data['phone']}\n\n"
-            f"---\n\n"
-            f"### Ждем вас!\n\n"
-            f"Если передумаете, можете отменить запись:\n"
-            f"01:00\n\n"
-            f"---\n"
-        )
-        
-        kb = [
-            [InlineKeyboardButton("❌ Отменить эту запись", callback_data=f"cancel_{b_id}")],
-        ]
-        
-        await query.message.reply_text(
-            final_text,
-            reply_markup=InlineKeyboardMarkup(kb),
-            parse_mode='Markdown'
-        )
-        
-        context.user_data.clear()
+    day = datetime.fromisoformat(b.get("date")).strftime("%d.%m.%Y")
+    text, markup = my_bookings_view(query.from_user.id, f"✅ Запись на {day} {b.get('time')} отменена.\n\n")
+    await query.edit_message_text(text, reply_markup=markup)
 
-async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def handle_back_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    await start(update, context)
+
+@timed
+async def handle_back_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    
-    if query.data.startswith("cancel_"):
-        try:
-            bid = int(query.data.replace("cancel_", ""))
-        except ValueError:
-            await query.answer("❌ Ошибка отмены", show_alert=True)
-            return
-        
-        logger.info(f"Клиент отменяет запись #{bid}")
-        
-        bookings = load_bookings()
-        
-        for i, b in enumerate(bookings):
-            if b.get("id") == bid and b.get("status") == "confirmed":
-                if str(b.get("user_id")) != str(query.from_user.id):
-                    await query.answer("❌ Это не ваша запись", show_alert=True)
-                    return
-                
-                # ОТМЕНЯЕМ ЗАПИСЬ
-                bookings[i]["status"] = "cancelled"
-                bookings[i]["cancelled_at"] = datetime.now().isoformat()
-                bookings[i]["cancelled_by"] = "client"
-                save_bookings(bookings)
-                
-                # Уведомление админу
-                try:
-                    await context.bot.send_message(
-                        ADMIN_ID, 
-                        f"❌ КЛИЕНТ ОТМЕНИЛ ЗАПИСЬ #{bid}\n"
-                        f"👤 {b.get('name')} ({b.get('phone')})\n"
-                        f"📅 {b.get('date')} {b.get('time')}\n"
-                        f"💈 {', '.join(b.get('services', []))}"
-                    )
-                except Exception as e:
-                    logger.error("Admin notify error: %s", e)
-                
-                # Сообщение об отмене
-                date_display = datetime.fromisoformat(b.get('date')).strftime('%d.%m.%Y')
-                
-                await query.edit_message_text(
-                    f"✅ *Запись отменена!*\n\n"
-                    f"📅 {date_display} {b.get('time')}\n"
-                    f"💈 {', '.join(b.get('services', []))}\n\n"
-                    f"Для новой записи нажмите /start",
-                    parse_mode='Markdown'
-                )
-                return
-        
-        await query.answer("❌ Запись не найдена", show_alert=True)
 
-async def handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await query.edit_message_text(
+        "Выберите услуги (нажмите для отметки):",
+        reply_markup=services_keyboard(context.user_data.get("selected_services", []))
+    )
+
+@timed
+async def handle_back_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    
-    if query.data == "back_start":
-        await start(update, context)
+
+    await query.edit_message_text(
+        "Выберите дату:",
+        reply_markup=date_keyboard(flow_master(context), flow_duration(context))
+    )
+
+def notify_admin_cancelled(b):
+    notify(
+        int(b.get('user_id')),
+        f"❌ *Ваша запись отменена администратором*\n\n"
+        f"📅 {datetime.fromisoformat(b['date']).strftime('%d.%m.%Y')} {b['time']}\n"
+        f"💈 {', '.join(b.get('services', []))}\n\n"
+        f"Для новой записи нажмите /start",
+        parse_mode='Markdown'
+    )
 
 # КОМАНДА ДЛЯ АДМИНА
-async def admin_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("⛔ Доступ запрещен")
-        return
-    
-    bookings = load_bookings()
-    active_bookings = [b for b in bookings if b.get('status') == 'confirmed']
-    
-    if not active_bookings:
-        await update.message.reply_text("📭 Активных записей нет")
-        return
+ADMIN_FILTERS = {"today": "сегодня", "week": "неделя", "all": "все"}
+
+def admin_filter_range(flt):
+    today = date.today()
+    if flt == "today":
+        return today.isoformat(), (today + timedelta(days=1)).isoformat()
+    if flt == "week":
+        return today.isoformat(), (today + timedelta(days=7)).isoformat()
+    if flt == "all":
+        return today.isoformat(), None
+    day = date.fromisoformat(flt)
+    return flt, (day + timedelta(days=1)).isoformat()
+
+def render_admin_page(master, flt, page):
+    store = master.store
+    date_from, date_to = admin_filter_range(flt)
+    total = store.page(date_from, date_to, limit=0)[1]
+    pages = max(1, -(-total // ADMIN_PAGE_SIZE))
+    page = max(0, min(page, pages - 1))
+    items, _ = store.page(date_from, date_to, page * ADMIN_PAGE_SIZE, ADMIN_PAGE_SIZE)
     
-    text = "📊 *Активные записи:*\n\n"
+    title = ADMIN_FILTERS.get(flt) or datetime.fromisoformat(flt).strftime('%d.%m.%Y')
+    if len(masters) > 1:
+        title = f"{master.name}, {title}"
+    lines = [f"📊 *Активные записи* ({title}): {total}\n"]
     kb = []
     
-    for b in active_bookings:
+    if not items:
+        lines.append("📭 Активных записей нет")
+    
+    for b in items:
         date_display = datetime.fromisoformat(b['date']).strftime('%d.%m.%Y')
-        text += f"🔹 {date_display} {b['time']}\n"
-        text += f"   👤 {b.get('name')} ({b.get('phone')})\n"
-        text += f"   💈 {', '.join(b.get('services', []))}\n"
-        text += f"   ID: #{b.get('id')}\n\n"
-        
+        lines.append(
+            f"🔹 {date_display} {time_span(b['time'], b.get('duration') or master.interval)}\n"
+            f"   👤 {b.get('name')} ({b.get('phone')})\n"
+            f"   💈 {', '.join(b.get('services', []))}\n"
+            f"   ID: #{b.get('id')}\n"
+        )
         kb.append([InlineKeyboardButton(
             f"🗑️ Удалить {date_display} {b['time']}", 
-            callback_data=f"admin_cancel_{b['id']}"
+            callback_data=cb("ac", b["id"])
         )])
     
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=cb("ap", master.id, flt, page - 1)))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=cb("an")))
+        if page + 1 < pages:
+            nav.append(InlineKeyboardButton("▶️", callback_data=cb("ap", master.id, flt, page + 1)))
+        kb.append(nav)
+    
+    kb.append([
+        InlineKeyboardButton("📅 Сегодня", callback_data=cb("ap", master.id, "today", 0)),
+        InlineKeyboardButton("🗓 Неделя", callback_data=cb("ap", master.id, "week", 0)),
+        InlineKeyboardButton("📋 Все", callback_data=cb("ap", master.id, "all", 0)),
+    ])
+    
+    if len(masters) > 1:
+        kb.append([
+            InlineKeyboardButton(f"{'• ' if m is master else ''}{m.name}", callback_data=cb("ap", m.id, flt, 0))
+            for m in masters.values()
+        ])
+    
+    # Отмена всего дня — только когда фильтр и есть один день
+    if total and (flt == "today" or flt not in ADMIN_FILTERS):
+        kb.append([InlineKeyboardButton(f"🗑 Отменить все записи дня ({total})", callback_data=cb("ad", master.id, date_from))])
+    
+    return "\n".join(lines), InlineKeyboardMarkup(kb)
+
+@timed
+async def admin_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+    
+    # /bookings [мастер] [today|week|all|ГГГГ-ММ-ДД]
+    args = list(context.args or [])
+    master = masters[args.pop(0)] if args and args[0] in masters else default_master()
+    flt = args[0] if args else "all"
+    if flt not in ADMIN_FILTERS:
+        try:
+            date.fromisoformat(flt)
+        except ValueError:
+            await update.message.reply_text("Использование: /bookings [мастер] [today|week|all|ГГГГ-ММ-ДД]")
+            return
+    
+    text, markup = render_admin_page(master, flt, 0)
     await update.message.reply_text(
         text, 
-        reply_markup=InlineKeyboardMarkup(kb),
+        reply_markup=markup,
         parse_mode='Markdown'
     )
 
+@timed
+async def handle_admin_page(update: Update, context: ContextTypes.DEFAULT_TYPE, master, flt, page):
+    query = update.callback_query
+    await query.answer()
+    text, markup = render_admin_page(master, flt, page)
+    await query.edit_message_text(text, reply_markup=markup, parse_mode='Markdown')
+
+@timed
+async def handle_admin_noop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+
+@timed
+async def handle_admin_cancel_day(update: Update, context: ContextTypes.DEFAULT_TYPE, master, iso):
+    # Переспрашиваем: отмена целого дня необратима
+    query = update.callback_query
+    total = master.store.page(*admin_filter_range(iso), limit=0)[1]
+    await query.answer()
+    await query.edit_message_text(
+        f"⚠️ Отменить все записи на {datetime.fromisoformat(iso).strftime('%d.%m.%Y')} ({total})?\n"
+        f"Мастер: {master.name}. Клиенты получат уведомление.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Да, отменить все", callback_data=cb("ay", master.id, iso))],
+            [InlineKeyboardButton("🔙 Назад", callback_data=cb("ap", master.id, iso, 0))],
+        ])
+    )
+
+@timed
+async def handle_admin_cancel_day_ok(update: Update, context: ContextTypes.DEFAULT_TYPE, master, iso):
+    query = update.callback_query
+    items, total = master.store.page(*admin_filter_range(iso))
+    try:
+        # Одна запись в хранилище на весь день
+        await master.store.cancel_many(items, "admin")
+    except STORAGE_ERRORS:
+        await query.answer("Не удалось отменить записи, попробуйте ещё раз", show_alert=True)
+        return
+    logger.info("Админ отменил все записи мастера %s на %s (%d)", master.id, iso, total)
+    await query.answer()
+    
+    for b in items:
+        notify_admin_cancelled(b)
+    
+    await query.edit_message_text(
+        f"✅ Отменено записей на {datetime.fromisoformat(iso).strftime('%d.%m.%Y')}: {total}"
+    )
+
 # ОБРАБОТЧИК ОТМЕНЫ АДМИНОМ
-async def handle_admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed
+async def handle_admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, bid):
     query = update.callback_query
+    logger.info(f"Админ отменяет запись #{bid}")
+    
+    master, b = find_booking(bid)
+    if b is None:
+        await query.answer("❌ Запись не найдена или уже отменена", show_alert=True)
+        return
+    
+    try:
+        # ОТМЕНЯЕМ ЗАПИСЬ
+        await master.store.cancel(b, "admin")
+    except STORAGE_ERRORS:
+        await query.answer("Не удалось отменить запись, попробуйте ещё раз", show_alert=True)
+        return
     await query.answer()
     
-    if query.data.startswith("admin_cancel_"):
-        try:
-            bid = int(query.data.replace("admin_cancel_", ""))
-        except ValueError:
-            await query.answer("❌ Ошибка отмены", show_alert=True)
-            return
-        
-        if query.from_user.id != ADMIN_ID:
-            await query.answer("❌ Только админ может отменять записи", show_alert=True)
-            return
-        
-        logger.info(f"Админ отменяет запись #{bid}")
-        
-        bookings = load_bookings()
-        booking_found = False
-        
-        for i, b in enumerate(bookings):
-            if b.get("id") == bid and b.get("status") == "confirmed":
-                booking_found = True
-                
-                # ОТМЕНЯЕМ ЗАПИСЬ
-                bookings[i]["status"] = "cancelled"
-                bookings[i]["cancelled_at"] = datetime.now().isoformat()
-                bookings[i]["cancelled_by"] = "admin"
-                save_bookings(bookings)
-                
-                # Уведомление клиенту
-                try:
-                    user_id = int(b.get('user_id'))
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=(
-                            f"❌ *Ваша запись отменена администратором*\n\n"
-                            f"📅 {datetime.fromisoformat(b['date']).strftime('%d.%m.%Y')} {b['time']}\n"
-                            f"💈 {', '.join(b.get('services', []))}\n\n"
-                            f"Для новой записи нажмите /start"
-                        ),
-                        parse_mode='Markdown'
-                    )
-                except Exception as e:
-                    logger.error(f"Error notifying user: {e}")
-                
-                # Обновляем сообщение админа
-                await query.edit_message_text(
-                    f"✅ *Запись #{bid} отменена*\n\n"
-                    f"👤 {b.get('name')} ({b.get('phone')})\n"
-                    f"📅 {b.get('date')} {b.get('time')}\n"
-                    f"💈 {', '.join(b.get('services', []))}",
-                    parse_mode='Markdown'
-                )
-                break
-        
-        if not booking_found:
-            await query.answer("❌ Запись не найдена или уже отменена", show_alert=True)
+    # Уведомление клиенту
+    notify_admin_cancelled(b)
+    
+    # Обновляем сообщение админа
+    await query.edit_message_text(
+        f"✅ *Запись #{bid} отменена*\n\n"
+        f"👤 {b.get('name')} ({b.get('phone')})\n"
+        f"📅 {b.get('date')} {b.get('time')}\n"
+        f"💈 {', '.join(b.get('services', []))}",
+        parse_mode='Markdown'
+    )
 
 # ОБРАБОТЧИК КОМАНДЫ УДАЛЕНИЯ ДЛЯ АДМИНА
+@timed
 async def handle_delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("⛔ Доступ запрещен")
@@ -557,74 +3548,527 @@ async def handle_delete_command(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text("❌ Неверный ID записи")
             return
         
-        bookings = load_bookings()
-        booking_found = False
+        master, b = find_booking(bid)
+        if b is None:
+            await update.message.reply_text("❌ Запись не найдена или уже отменена")
+            return
         
-        for i, b in enumerate(bookings):
-            if b.get("id") == bid and b.get("status") == "confirmed":
-                booking_found = True
-                
-                # ОТМЕНЯЕМ ЗАПИСЬ
-                bookings[i]["status"] = "cancelled"
-                bookings[i]["cancelled_at"] = datetime.now().isoformat()
-                bookings[i]["cancelled_by"] = "admin"
-                save_bookings(bookings)
-                
-                # Уведомление клиенту
-                try:
-                    user_id = int(b.get('user_id'))
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=(
-                            f"❌ *Ваша запись отменена администратором*\n\n"
-                            f"📅 {datetime.fromisoformat(b['date']).strftime('%d.%m.%Y')} {b['time']}\n"
-                            f"💈 {', '.join(b.get('services', []))}\n\n"
-                            f"Для новой записи нажмите /start"
-                        ),
-                        parse_mode='Markdown'
-                    )
-                except Exception as e:
-                    logger.error(f"Error notifying user: {e}")
-                
-                await update.message.reply_text(
-                    f"✅ *Запись #{bid} отменена*\n\n"
-                    f"👤 {b.get('name')} ({b.get('phone')})\n"
-                    f"📅 {b.get('date')} {b.get('time')}\n"
-                    f"💈 {', '.join(b.get('services', []))}",
-                    parse_mode='Markdown'
-                )
-                break
+        try:
+            # ОТМЕНЯЕМ ЗАПИСЬ
+            await master.store.cancel(b, "admin")
+        except STORAGE_ERRORS:
+            await update.message.reply_text("❌ Не удалось отменить запись, попробуйте ещё раз")
+            return
         
-        if not booking_found:
-            await update.message.reply_text("❌ Запись не найдена или уже отменена")
+        # Уведомление клиенту
+        notify_admin_cancelled(b)
+        
+        await update.message.reply_text(
+            f"✅ *Запись #{bid} отменена*\n\n"
+            f"👤 {b.get('name')} ({b.get('phone')})\n"
+            f"📅 {b.get('date')} {b.get('time')}\n"
+            f"💈 {', '.join(b.get('services', []))}",
+            parse_mode='Markdown'
+        )
+
+# ИСТОРИЯ ИЗ АРХИВА
+@timed
+async def admin_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+    
+    # /history [мастер] [ГГГГ-ММ]
+    args = list(context.args or [])
+    master = masters[args.pop(0)] if args and args[0] in masters else default_master()
+    title = f" ({master.name})" if len(masters) > 1 else ""
+    
+    if not args:
+        months = await asyncio.to_thread(master.archive.months)
+        await update.message.reply_text(
+            f"🗄 Архив{title}: {', '.join(months) if months else 'пока пуст'}\n\n"
+            f"Использование: /history [мастер] ГГГГ-ММ"
+        )
+        return
+    
+    month = args[0]
+    try:
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        await update.message.reply_text("Использование: /history [мастер] ГГГГ-ММ")
+        return
+    
+    # Архив читается с диска — не в цикле событий
+    items = await asyncio.to_thread(master.archive.read, month)
+    items.sort(key=lambda b: (b.get("date", ""), b.get("time", "")))
+    done = sum(1 for b in items if b.get("status") == "confirmed")
+    
+    lines = [
+        f"🗄 Архив за {month}{title}",
+        f"✅ Состоялись: {done}",
+        f"❌ Отменены: {len(items) - done}",
+        "",
+    ]
+    size = sum(len(line) + 1 for line in lines)
+    for i, b in enumerate(items):
+        mark = "✅" if b.get("status") == "confirmed" else "❌"
+        line = (
+            f"{mark} {datetime.fromisoformat(b['date']).strftime('%d.%m')} {b.get('time')} — "
+            f"{b.get('name')} ({b.get('phone')}), {', '.join(b.get('services', []))}"
+        )
+        if size + len(line) > HISTORY_TEXT_LIMIT:
+            lines.append(f"…и ещё {len(items) - i}")
+            break
+        lines.append(line)
+        size += len(line) + 1
+    
+    await update.message.reply_text("\n".join(lines))
+
+# СТАТИСТИКА И ВЫГРУЗКА
+def stats_period(stats, period):
+    # -> (заголовок, счётчики, дней в периоде)
+    today = date.today()
+    if period == "today":
+        return "сегодня", stats.days.get(today.isoformat(), Stats._zero()), 1
+    if period == "week":
+        return ADMIN_FILTERS["week"], stats.range(*admin_filter_range("week")), 7
+    if period == "all":
+        return "всё время", stats.total, max(1, len(stats.days))
+    if period == "month":
+        period = today.strftime("%Y-%m")
+    if len(period) == 7:
+        first = datetime.strptime(period, "%Y-%m").date()
+        days = ((first + timedelta(days=31)).replace(day=1) - first).days
+        return first.strftime("%m.%Y"), stats.months.get(period, Stats._zero()), days
+    day = date.fromisoformat(period)
+    return day.strftime("%d.%m.%Y"), stats.days.get(period, Stats._zero()), 1
+
+def render_stats(master, period):
+    stats = master.stats
+    title, counters, days = stats_period(stats, period)
+    if len(masters) > 1:
+        title = f"{master.name}, {title}"
+    capacity = stats.capacity(days)
+    lines = [
+        f"📈 Статистика ({title})",
+        f"💰 Выручка: {format_price(counters['revenue'])}",
+        f"✅ Записей: {counters['bookings']}",
+        f"❌ Отмен: {counters['cancelled']}",
+        f"📊 Загрузка: {counters['minutes'] * 100 // capacity if capacity else 0}%",
+        "",
+        "💈 Услуги за всё время:",
+    ]
+    for sid, c in sorted(stats.services.items(), key=lambda item: -item[1]["revenue"]):
+        service = SERVICE_BY_ID.get(int(sid))
+        if service is not None:
+            lines.append(f"{service['icon']} {service['name']}: {c['bookings']} — {format_price(c['revenue'])}")
+    hours = sorted((item for item in stats.hours.items() if item[1]["bookings"] > 0),
+                   key=lambda item: -item[1]["bookings"])[:3]
+    if hours:
+        lines.append("")
+        lines.append("🕐 Популярные часы: " + ", ".join(f"{int(h):02d}:00 ({c['bookings']})" for h, c in hours))
+    return "\n".join(lines)
+
+@timed
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+    
+    # /stats [мастер] [today|week|month|all|ГГГГ-ММ|ГГГГ-ММ-ДД]
+    args = list(context.args or [])
+    master = masters[args.pop(0)] if args and args[0] in masters else default_master()
+    period = args[0] if args else "month"
+    try:
+        text = render_stats(master, period)
+    except ValueError:
+        await update.message.reply_text("Использование: /stats [мастер] [today|week|month|all|ГГГГ-ММ|ГГГГ-ММ-ДД]")
+        return
+    await update.message.reply_text(text)
+
+@timed
+async def admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+    
+    # /export [мастер] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]; по умолчанию — текущий месяц
+    args = list(context.args or [])
+    master = masters[args.pop(0)] if args and args[0] in masters else default_master()
+    try:
+        first = date.fromisoformat(args[0]) if args else date.today().replace(day=1)
+        last = (date.fromisoformat(args[1]) if len(args) > 1
+                else (first + timedelta(days=31)).replace(day=1) - timedelta(days=1))
+    except ValueError:
+        first = last = None
+    if first is None or last < first:
+        await update.message.reply_text("Использование: /export [мастер] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]")
+        return
+    
+    date_from, date_to = first.isoformat(), (last + timedelta(days=1)).isoformat()
+    live = [dict(b) for b in master.store.bookings if date_from <= b.get("date", "") < date_to]
+    fd, path = tempfile.mkstemp(prefix="export-", suffix=".csv")
+    os.close(fd)
+    try:
+        # Архив читается с диска — не в цикле событий
+        count = await asyncio.to_thread(export_csv, master, live, date_from, date_to, path)
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                f,
+                filename=f"bookings_{master.id}_{date_from}_{last.isoformat()}.csv",
+                caption=f"📤 Записей: {count} ({first.strftime('%d.%m.%Y')} — {last.strftime('%d.%m.%Y')})",
+            )
+    finally:
+        os.remove(path)
 
 # Обработчик ошибок
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Exception while handling an update: {context.error}")
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    err = context.error
+    metrics.inc("bot_errors_total", error=type(err).__name__)
+    info = {"error": type(err).__name__, "message": str(err)}
+    if isinstance(update, Update):
+        info["update_id"] = update.update_id
+        if update.effective_user:
+            info["user_id"] = update.effective_user.id
+        if update.effective_chat:
+            info["chat_id"] = update.effective_chat.id
+        if update.callback_query:
+            info["callback_data"] = update.callback_query.data
+        elif update.effective_message and update.effective_message.text:
+            info["text"] = update.effective_message.text[:100]
+        if context.user_data:
+            info["flow"] = sorted(k for k in context.user_data if k in FLOW_KEYS)
+    logger.error("Exception while handling an update: %s", json.dumps(info, ensure_ascii=False), exc_info=err)
 
-# ---------------- MAIN ----------------
-def main():
+# ---------------- Callback router ----------------
+# код -> (обработчик, проверки аргументов); аргументы уходят в обработчик уже проверенными
+CALLBACK_ROUTES = {
+    "b": (handle_book, ()),
+    "m": (handle_master, (arg_master,)),
+    "s": (handle_service, (arg_service,)),
+    "sd": (handle_services_done, ()),
+    "d": (handle_date, (arg_date,)),
+    "df": (handle_date_full, ()),
+    "t": (handle_time, (arg_time,)),
+    "x": (handle_busy, ()),
+    "w": (handle_waitlist, (arg_time,)),
+    "bs": (handle_back_start, ()),
+    "bv": (handle_back_services, ()),
+    "bd": (handle_back_dates, ()),
+    "cb": (handle_confirm, ()),
+    "cf": (handle_cancel_flow, ()),
+    "c": (handle_cancel, (arg_int,)),
+    "my": (handle_my, ()),
+    "mc": (handle_my_cancel, (arg_int,)),
+    "ac": (handle_admin_cancel, (arg_int,)),
+    "ap": (handle_admin_page, (arg_master, arg_filter, arg_int)),
+    "an": (handle_admin_noop, ()),
+    "ad": (handle_admin_cancel_day, (arg_master, arg_date)),
+    "ay": (handle_admin_cancel_day_ok, (arg_master, arg_date)),
+}
+ADMIN_CALLBACKS = {"ac", "ap", "an", "ad", "ay"}
+COALESCED_CALLBACKS = {"s"}   # правят сообщение через edits.schedule
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Один CallbackQueryHandler на все кнопки: разбор и поиск обработчика — O(1)
+    query = update.callback_query
+    code, args = parse_callback(query.data or "")
+    route = CALLBACK_ROUTES.get(code)
     try:
-        app = Application.builder().token(BOT_TOKEN).build()
-        logger.info("✅ Бот создан успешно!")
-    except Exception as e:
-        logger.error(f"❌ Ошибка создания бота: {e}")
+        if route is None or len(args) != len(route[1]):
+            raise ValueError(query.data)
+        args = [check(value) for check, value in zip(route[1], args)]
+    except (ValueError, KeyError):
+        metrics.inc("bot_callbacks_rejected_total")
+        logger.warning("Неверная callback_data %r от %s", query.data, query.from_user.id)
+        await query.answer("Кнопка устарела. /start чтобы начать заново.", show_alert=True)
+        return
+
+    if code in ADMIN_CALLBACKS and query.from_user.id != ADMIN_ID:
+        await query.answer("⛔ Доступ запрещен", show_alert=True)
         return
+    if code not in COALESCED_CALLBACKS:
+        # Эта кнопка сама правит сообщение — отложенная правка услуг затёрла бы её
+        edits.discard(query)
+    await route[0](update, context, *args)
+
+# ---------------- Rate limiting ----------------
+class RateLimiter:
+    """Лимиты на пользователя: общий TokenBucket и отдельный на тип апдейта.
+
+    Наполнившиеся до burst ведра ничем не отличаются от новых, поэтому
+    раз в минуту выбрасываются. Частично пустые остаются: иначе
+    засыпающий кнопками клиент получал бы полный burst заново.
+    """
+
+    SWEEP_SEC = 60
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}   # (user_id, тип) -> TokenBucket
+        self._swept = monotonic()
+
+    def _take(self, key, limit):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*limit)
+        if bucket.wait_time() > 0:
+            return False
+        bucket.consume()
+        return True
+
+    def allow(self, user_id, kind):
+        if monotonic() - self._swept > self.SWEEP_SEC:
+            self._swept = monotonic()
+            self.buckets = {k: b for k, b in self.buckets.items() if not b.full()}
+        limit = self.limits.get(kind)
+        if limit is not None and not self._take((user_id, kind), limit):
+            return False
+        return self._take((user_id, "*"), self.limits["*"])
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+def update_kind(update):
+    # Тип апдейта для лимитов: код кнопки (со старыми форматами) или "msg"
+    if update.callback_query is not None:
+        return parse_callback(update.callback_query.data or "")[0]
+    return "msg"
+
+async def admit(update, pending):
+    # Вызывается до очереди чата и до обработчиков: отказ не трогает ни хранилище, ни user_data
+    user = update.effective_user
+    if user is None or user.id == ADMIN_ID:
+        return True
+    kind = update_kind(update)
+    if pending > SHED_PENDING and kind not in SHED_KEEP and kind != "msg":
+        reason, text = "shed", "⏳ Бот перегружен, нажмите ещё раз через несколько секунд"
+    elif not rate_limiter.allow(user.id, kind):
+        reason, text = "rate", "⏳ Слишком часто, подождите немного"
+    else:
+        return True
+    # Коды кнопок — конечный набор, неизвестные сводим в "other"
+    metrics.inc("bot_updates_throttled_total", kind=kind if kind in CALLBACK_ROUTES or kind == "msg" else "other",
+                reason=reason)
+    if update.callback_query is not None:
+        # Без ответа у клиента крутятся «часики» на кнопке
+        try:
+            await update.callback_query.answer(text)
+        except TelegramError:
+            pass
+    return False
+
+# ---------------- Update processing ----------------
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных чатов.
+
+    Апдейты одного чата выполняются строго по очереди (FIFO-замок на
+    чат), поэтому нажатия svc_* и ответы текстом применяются к
+    context.user_data в том порядке, в каком пришли. Предел
+    параллелизма берётся уже после замка чата, чтобы один
+    засыпающий кнопками клиент не занимал слоты остальных.
+    Ещё раньше, до очереди чата, апдейт проходит лимиты (admit):
+    отклонённые не ждут в очереди и не держат семафор. Бенчмарки
+    самого процессора выключают их через admission=False.
+    """
+
+    def __init__(self, max_concurrent_updates, admission=True):
+        # Семафор базового класса ограничивает число ожидающих задач,
+        # реальный параллелизм — self._running
+        super().__init__(max_concurrent_updates * 32)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}   # chat_id -> [asyncio.Lock, число ожидающих]
+        self.pending = 0        # апдейтов в работе и в очередях
+        self.admission = admission
+
+    @staticmethod
+    def _chat_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        self.pending += 1
+        try:
+            admitted = False
+            try:
+                admitted = not (self.admission and isinstance(update, Update)) or await admit(update, self.pending)
+            finally:
+                # Отклонён или admit упал — обработчик не запустится, корутину закрываем
+                if not admitted:
+                    coroutine.close()
+            if admitted:
+                await self._process(update, coroutine)
+        finally:
+            self.pending -= 1
+
+    async def _process(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ---------------- MAIN ----------------
+_metrics_server = None
+
+async def on_startup(app: Application):
+    global _metrics_server
+    for m in masters.values():
+        m.store.writer.start()
+    outbox.start(app.bot)
+    flow_state.start()
+    archiver.start()
+    reminders.start()
+    stats_writer.start()
+    if profiler is not None:
+        profiler.start()
+    # В режиме webhook /metrics отдаёт основной сервер
+    if RUN_MODE != "webhook" and METRICS_PORT:
+        import tornado.httpserver
+        _metrics_server = tornado.httpserver.HTTPServer(build_web_app(app, webhook=False))
+        _metrics_server.listen(METRICS_PORT)
+        logger.info("✅ /metrics слушает порт %d", METRICS_PORT)
+
+async def on_shutdown(app: Application):
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.stop()
+        _metrics_server = None
+    if profiler is not None:
+        profiler.stop()
+    await outbox.stop()
+    await flow_state.stop()
+    await archiver.stop()
+    await reminders.stop()
+    await edits.stop()
+    # Сворачиваем журналы при остановке, чтобы следующий старт читал один снимок
+    for m in masters.values():
+        await m.store.aclose()
+    # Последней: подтверждения из очередей записи тоже должны попасть в статистику
+    await stats_writer.stop()
+
+# ---------------- Webhook ----------------
+def current_gauges(app: Application):
+    gauges = {
+        ("bot_update_queue", ()): app.update_queue.qsize(),
+        ("bot_outbox_pending", ()): len(outbox.pending),
+        ("bot_reminders_scheduled", ()): len(reminders.heap),
+    }
+    for m in masters.values():
+        gauges[("bot_active_bookings", (("master", m.id),))] = len(m.store.active)
+        gauges[("bot_slot_holds", (("master", m.id),))] = len(m.holds)
+    return gauges
+
+def build_web_app(app: Application, webhook=True):
+    # tornado ставится вместе с python-telegram-bot[webhooks] и нужен только здесь
+    import tornado.web
 
+    class WebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                self.set_status(403)
+                return
+            try:
+                data = json.loads(self.request.body)
+            except ValueError:
+                self.set_status(400)
+                return
+            await app.update_queue.put(Update.de_json(data, app.bot))
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_status(200 if app.running else 503)
+            self.write({
+                "status": "ok" if app.running else "unavailable",
+                "mode": RUN_MODE,
+                "update_queue": app.update_queue.qsize(),
+                "outbox": len(outbox.pending),
+            })
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write(metrics.render(current_gauges(app)))
+
+    routes = [
+        (r"/healthz", HealthHandler),
+        (r"/metrics", MetricsHandler),
+    ]
+    if webhook:
+        routes.append((WEBHOOK_PATH, WebhookHandler))
+    return tornado.web.Application(routes)
+
+async def run_webhook(app: Application):
+    import tornado.httpserver
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    await on_startup(app)
+    # Не сбрасываем накопившиеся апдейты — Telegram дошлёт их после старта
+    await app.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=False,
+    )
+    await app.start()
+
+    server = tornado.httpserver.HTTPServer(build_web_app(app))
+    server.listen(PORT)
+    logger.info("✅ Webhook слушает порт %d", PORT)
+
+    await stop.wait()
+
+    # Корректная остановка: перестаём принимать запросы, дорабатываем очередь апдейтов.
+    # Вебхук не удаляем — апдейты, пришедшие во время рестарта, Telegram повторит.
+    logger.info("Останавливаемся...")
+    server.stop()
+    await app.stop()
+    await app.shutdown()
+    await on_shutdown(app)
+
+def register_handlers(app: Application):
+    # Состояние незаконченной записи: восстановить до обработчиков, запомнить после
+    app.add_handler(TypeHandler(Update, restore_flow_state), group=-1)
+    app.add_handler(TypeHandler(Update, track_flow_state), group=1)
+    
     # ОБРАБОТЧИКИ
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("my", my_bookings))
     app.add_handler(CommandHandler("bookings", admin_bookings))
+    app.add_handler(CommandHandler("history", admin_history))
+    app.add_handler(CommandHandler("stats", admin_stats))
+    app.add_handler(CommandHandler("export", admin_export))
     app.add_handler(MessageHandler(filters.Regex(r'^/delete_\d+'), handle_delete_command))
     
-    # Обработчики callback
-    app.add_handler(CallbackQueryHandler(handle_book, pattern="^book$"))
-    app.add_handler(CallbackQueryHandler(handle_service, pattern="^svc_"))
-    app.add_handler(CallbackQueryHandler(handle_date, pattern="^date_"))
-    app.add_handler(CallbackQueryHandler(handle_time, pattern="^time_"))
-    app.add_handler(CallbackQueryHandler(handle_back, pattern="^back_"))
-    app.add_handler(CallbackQueryHandler(handle_confirm, pattern="^(confirm_book|cancel_flow)$"))
-    app.add_handler(CallbackQueryHandler(handle_cancel, pattern="^cancel_"))
-    app.add_handler(CallbackQueryHandler(handle_admin_cancel, pattern="^admin_cancel_"))
+    # Все кнопки — через один роутер (CALLBACK_ROUTES)
+    app.add_handler(CallbackQueryHandler(route_callback))
     
     # Обработчики сообщений
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, name_handler))
@@ -633,12 +4077,61 @@ def main():
     # Обработчик ошибок
     app.add_error_handler(error_handler)
 
-    logger.info("✅ Бот запускается...")
+def load_state():
+    # Загружаем записи один раз, дальше работаем с индексом в памяти
+    for m in masters.values():
+        m.store.load()
+        m.store.listeners.append(partial(reminders.on_booking, m.id))
+        m.stats.load(m.archive)
+        m.store.listeners.append(m.stats.on_booking)
+        m.store.listeners.append(m.notify_waitlist)
+    reminders.rebuild()
+    outbox.load()
+    flow_state.open()
+
+def main():
+    # Проверка токена
+    if not BOT_TOKEN:
+        logging.error("❌ BOT_TOKEN not set! Please set environment variable.")
+        exit(1)
+
+    if not ADMIN_ID:
+        logging.error("❌ ADMIN_ID not set! Please set environment variable.")
+        exit(1)
+
+    if RUN_MODE == "webhook" and not WEBHOOK_URL:
+        logging.error("❌ WEBHOOK_URL not set! It is required for RUN_MODE=webhook.")
+        exit(1)
+
+    try:
+        app = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .request(InstrumentedRequest(connection_pool_size=256))
+            .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
+        logger.info("✅ Бот создан успешно!")
+    except Exception as e:
+        logger.error(f"❌ Ошибка создания бота: {e}")
+        return
+
+    register_handlers(app)
+    load_state()
+
+    logger.info("✅ Бот запускается (%s)...", RUN_MODE)
     
-    # Бесконечный перезапуск при ошибках
+    if RUN_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+        return
+    
+    # Перезапуск при ошибках; апдейты, накопившиеся за время простоя, не выбрасываем
     while True:
         try:
-            app.run_polling(drop_pending_updates=True)
+            app.run_polling(drop_pending_updates=False)
+            break  # штатная остановка по сигналу
         except Exception as e:
             logger.error(f"❌ Бот упал: {e}")
             logger.info("🔄 Перезапуск через 10 секунд...")
@@ -646,4 +4139,13 @@ def main():
             time.sleep(10)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # python bot.py migrate [bookings.json] — перенос JSON-хранилища в SQLite
+    # (без пути — хранилища всех мастеров, каждое в свою базу)
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        if len(sys.argv) > 2:
+            migrate_json_to_sqlite(sys.argv[2])
+        else:
+            for m in masters.values():
+                migrate_json_to_sqlite(m.file(DATA_FILE), m.file(SQLITE_FILE), m.interval)
+    else:
+        main()
\ No newline at end of file